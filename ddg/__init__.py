@@ -27,13 +27,13 @@
 This package contains protocols for creating and using IIITD Raghava software
 """
 
-import multiprocessing
+import os, time, multiprocessing
 
 from scipion.install.funcs import InstallHelper
+from pyworkflow import Config
 
 from pwchem import Plugin as pwchemPlugin
 
-from .utils import *
 from .constants import *
 
 # Pluging variables
@@ -47,6 +47,8 @@ class Plugin(pwchemPlugin):
 	def _defineVariables(cls):
 		cls._defineVar(DDG_DIC['browser'], 'Chrome')
 		cls._defineVar(DDG_DIC['browserPath'], '/usr/bin/google-chrome')
+		cls._defineVar(DDG_DIC['history'], os.path.join(Config.SCIPION_USER_DATA, 'ddg_history.jsonl'))
+		cls._defineVar(DDG_DIC['daemonSocket'], '')
 
 	@classmethod
 	def defineBinaries(cls, env, default=True):
@@ -62,40 +64,105 @@ class Plugin(pwchemPlugin):
 	def performEvaluations(cls, sequences, evalDics, jobs=1, browserData={}, verbose=True):
 		'''Generalize caller to the evaluation functions.
     - sequences: dict with sequences in the form: {seqId: sequence}
-    - evalDics: dictionary as {evalKey: {parameterName: parameterValue}}
-    - jobs: int, number of jobs for parallelization
+    - evalDics: dictionary as {evalKey: {parameterName: parameterValue}}. A list of values for a parameter sweeps it,
+    producing one evaluation {evalKey}_{value} per value (see getRegisteredEvalDics)
+    - jobs: int, maximum number of jobs for parallelization. The actual number and the chunk sizes are tuned from
+    the history of previous runs (see getRunHistory)
     Returns a dictionary of the form: {(evalKey, softwareName): [scores]}
     '''
-		funcDic = {
-			'Vaxijen2': callVaxijen2, 'Vaxijen3': callVaxijen3, 'AllerTop2': callAllerTop2, 'AllergenFP1': callAllergenFP1
-		}
-
-		# Create a pool of worker processes
-		nJobs = len(evalDics) if len(evalDics) < jobs else jobs
-		pool = multiprocessing.Pool(processes=nJobs)
-
-		resultsDic = {}
-		for evalKey, evalDic in evalDics.items():
-			softName = evalDic['software']
-			smallEvalDic = evalDic.copy()
-			del smallEvalDic['software']
-			if softName in funcDic:
-				resultsDic[(evalKey, softName)] = pool.apply_async(funcDic[softName],
-																													 args=(sequences, smallEvalDic, browserData))
+		from .utils import ScoreMatrix
+		evalDics = cls.getRegisteredEvalDics(evalDics)
+		scoreMatrix = ScoreMatrix(list(sequences), list(evalDics))
+		for evalKey, seqIds, scores in cls.iterEvaluations(sequences, evalDics, jobs, browserData, verbose):
+			scoreMatrix.setScores(evalKey, seqIds, scores)
+
+		return {(evalKey, evalDic['software']): scoreMatrix.getColumn(evalKey).tolist()
+						for evalKey, evalDic in evalDics.items()}
 
+	@classmethod
+	def iterEvaluations(cls, sequences, evalDics, jobs=1, browserData={}, verbose=True, metricsFile=None,
+											metricsLabels={}):
+		'''Generator version of performEvaluations, yielding the scores of each chunk of sequences as soon as it is
+		evaluated, so the whole set of results does not need to be kept in memory.
+    - sequences: dict with sequences in the form: {seqId: sequence}
+    - evalDics: dictionary as {evalKey: {parameterName: parameterValue}}
+    - jobs: int, maximum number of jobs for parallelization
+    - metricsFile: str, if not None, Prometheus text file where the evaluation metrics are periodically written
+    - metricsLabels: dict, labels added to all the written metrics (e.g: to identify the protocol)
+    Yields tuples of the form: (evalKey, [seqIds], array('d', scores))
+    '''
+		# Evaluation utils are imported on first use so they do not slow down the plugins discovery
+		from .utils import evaluateChunk, iterEvaluationTasks, countEvaluationTasks, streamPoolTasks, \
+			reportRuntimePrediction, getGroupSoftware
+		from .utils.metrics import MetricsRegistry, MetricsWriter
+		# The variants of a parameter sweep are evaluated together, sharing the inputs and browser sessions
+		evalGroups = cls.getEvaluationGroups(evalDics)
+
+		history = cls.getRunHistory()
+		runDics = {}
+		for groupKey, variantDics in evalGroups.items():
+			softName = getGroupSoftware(variantDics)
+			runDics[groupKey] = {'maxChunk': history.suggestChunkSize(softName, len(sequences), EVALUATORS[softName]['maxChunk']),
+													 'historyFile': history.historyFile, 'daemonSocket': cls.getVar(DDG_DIC['daemonSocket'])}
+		nTasks, doneTasks, nEvaluated = countEvaluationTasks(len(sequences), evalGroups, runDics), 0, 0
+		nJobs = history.suggestJobs([getGroupSoftware(variantDics) for variantDics in evalGroups.values()], nTasks, jobs)
+		for runData in runDics.values():
+			runData['jobs'] = nJobs
 		if verbose:
-			reportPoolStatus(resultsDic)
+			reportRuntimePrediction(history, sequences, evalGroups, runDics, nJobs)
+
+		seqIds = list(sequences)
+		tasks = iterEvaluationTasks(sequences, evalGroups, runDics, browserData)
+
+		metrics, startTime = MetricsRegistry(), time.time()
+		metrics.setGauge('ddg_chunks_pending', nTasks)
+		metricsWriter = MetricsWriter(metrics, metricsFile, constLabels=metricsLabels) if metricsFile else None
+		if metricsWriter:
+			metricsWriter.start()
+
+		# Create a pool of worker processes, keeping a bounded number of submitted chunks
+		try:
+			with multiprocessing.Pool(processes=nJobs) as pool:
+				for start, scoreDic, chunkMetrics in streamPoolTasks(pool, evaluateChunk, tasks, maxPending=2 * nJobs):
+					doneTasks = doneTasks + 1
+					metrics.merge(chunkMetrics)
+					metrics.setGauge('ddg_chunks_pending', nTasks - doneTasks)
+					for evalKey, scores in scoreDic.items():
+						nEvaluated += len(scores)
+						metrics.inc('ddg_chunks_completed_total', evaluator=evalKey)
+						metrics.inc('ddg_sequences_evaluated_total', len(scores), evaluator=evalKey)
+						if verbose:
+							print(f'{evalKey} chunk execution finished ({doneTasks} / {nTasks})')
+						yield evalKey, seqIds[start:start + len(scores)], scores
+					metrics.setGauge('ddg_sequences_per_second', nEvaluated / max(time.time() - startTime, 1e-6))
+				# Let the workers exit normally, so their finalizers quit the browsers. Leaving the with block terminates them,
+				# skipping the finalizers, so that is only left for the error path
+				pool.close()
+				pool.join()
+		finally:
+			if metricsWriter:
+				metricsWriter.stop()
 
-		pool.close()
-		pool.join()
+	# ---------------------------------- Utils functions-----------------------
+	@classmethod
+	def getBrowserData(cls):
+		return {'name': cls.getVar(DDG_DIC['browser']), 'path': cls.getVar(DDG_DIC['browserPath'])}
 
-		epiDics = {}
-		for (evalKey, softName), res in resultsDic.items():
-			epiDics[(evalKey, softName)] = res.get()['Score']
+	@classmethod
+	def getEvaluationGroups(cls, evalDics):
+		'''Returns the registered evaluations with their parameter sweeps expanded, grouped by the input evalKey:
+		{evalKey: {variantKey: {parameterName: parameterValue}}}'''
+		from .utils import expandEvalSweeps
+		return expandEvalSweeps({evalKey: evalDic for evalKey, evalDic in evalDics.items()
+														 if evalDic['software'] in EVALUATORS})
 
-		return epiDics
+	@classmethod
+	def getRegisteredEvalDics(cls, evalDics):
+		'''Returns the registered evaluations, with one evaluation per variant of the parameter sweeps'''
+		return {variantKey: variantDic for variantDics in cls.getEvaluationGroups(evalDics).values()
+						for variantKey, variantDic in variantDics.items()}
 
-	# ---------------------------------- Utils functions-----------------------
 	@classmethod
-	def getBrowserData(cls):
-		return {'name': cls.getVar(DDG_DIC['browser']), 'path': cls.getVar(DDG_DIC['browserPath'])}
\ No newline at end of file
+	def getRunHistory(cls):
+		from .utils import RunHistory
+		return RunHistory(cls.getVar(DDG_DIC['history']))
\ No newline at end of file
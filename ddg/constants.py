@@ -31,9 +31,46 @@ DEFAULT_VERSION = '3.0'
 # Package dictionaries
 DDG_DIC = {'name': 'DDG',    'version': '3.0',
            'home': 'DDG_HOME', 'activation': 'DDG_ACTIVATION_CMD',
-           'browser': 'DDG_BROWSER', 'browserPath': 'DDG_BROWSER_PATH'}
+           'browser': 'DDG_BROWSER', 'browserPath': 'DDG_BROWSER_PATH', 'history': 'DDG_HISTORY',
+           'daemonSocket': 'DDG_DAEMON_SOCKET'}
 
-EVAL_PARAM_MAP = {'ToxinPred': {'method': {'SVM (Swiss-Prot)': 1, 'SVM (Swiss-Prot) + Motif': 2, 'SVM (TrEMBL)': 3}}}
+# Sequence validation
+STD_RESIDUES = 'ACDEFGHIKLMNPQRSTVWY'
+MISSING_SCORE = float('nan')
+
+# Evaluation software registry: {softName: evaluatorData}
+# - url, seqName, submitCSS: web server address, name of the sequence input element and css selector of the submit button
+# - multi, seqFormat: whether the server admits several sequences per request and their format (fastaFile, fastaString)
+# - maxChunk: maximum number of sequences admitted per request (None if unknown)
+# - validation: local validation rules for the sequences (see utils.validateSequences). The servers do not document a
+#   maximum sequence length, so no maxLength is declared for them
+# - formParams: {protocolParamName: (formElementName, {protocolValue: formElementValue})} names and values of the web
+#   form elements set by the protocol parameters (see utils.mapFormParams)
+# - backend, parser: names of the request backend and parsing function, only imported when the evaluator is used
+EVALUATORS = {
+  'Vaxijen2': {'url': "https://www.ddg-pharmfac.net/vaxijen/VaxiJen/VaxiJen.html",
+               'seqName': 'uploaded_file', 'submitCSS': "input[name='submit']",
+               'multi': True, 'seqFormat': 'fastaFile', 'maxChunk': None, 'defaultParams': {"Target": 'Bacteria'},
+               'formParams': {'vaxi2Target': ('Target', {'bacteria': 'Bacteria', 'virus': 'Virus', 'tumor': 'Tumour',
+                                                         'parasite': 'Parasite', 'fungal': 'Fungal'})},
+               'validation': {'alphabet': STD_RESIDUES, 'minLength': 2},
+               'backend': 'selenium', 'parser': 'parseVaxijen2'},
+  'Vaxijen3': {'url': "https://www.ddg-pharmfac.net/vaxijen3/",
+               'seqName': 'uploaded_file', 'submitCSS': "input[name='submit']",
+               'multi': True, 'seqFormat': 'fastaFile', 'maxChunk': None,
+               'validation': {'alphabet': STD_RESIDUES, 'minLength': 2},
+               'backend': 'selenium', 'parser': 'parseVaxijen3'},
+  'AllerTop2': {'url': "https://www.ddg-pharmfac.net/AllerTOP/",
+                'seqName': 'sequence', 'submitCSS': "input[name='Submit']",
+                'multi': False, 'maxChunk': 1,
+                'validation': {'alphabet': STD_RESIDUES, 'minLength': 2},
+                'backend': 'selenium', 'parser': 'parseAllerDDG'},
+  'AllergenFP1': {'url': "https://ddg-pharmfac.net/AllergenFP/",
+                  'seqName': 'sequence', 'submitCSS': "input[name='Submit']",
+                  'multi': False, 'maxChunk': 1,
+                  'validation': {'alphabet': STD_RESIDUES, 'minLength': 2},
+                  'backend': 'selenium', 'parser': 'parseAllerDDG'},
+}
 
 EVALSUM = '''1) "Vaxijen2-1": {'software': 'Vaxijen2', 'vaxi2Target': 'bacteria'}
 2) "Vaxijen3-1": {'software': 'Vaxijen3'}
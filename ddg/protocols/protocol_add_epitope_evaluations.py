@@ -30,20 +30,21 @@ from pyworkflow.protocol import params
 from pwchem.objects import SetOfSequenceROIs
 
 from .. import Plugin as ddgPlugin
-from ..utils import mapEvalParamNames
+from ..constants import EVALUATORS
 
 class ProtDDGEvaluations(EMProtocol):
   """Run evaluations on a set of epitopes (SetOfSequenceROIs)"""
   _label = 'ddg epitope evaluations'
 
-  _evaluatorOptions = ['Vaxijen2', 'Vaxijen3', 'AllerTop2', 'AllergenFP1']
+  _evaluatorOptions = list(EVALUATORS)
 
   _vaxiTargets = ['bacteria', 'virus', 'tumor', 'parasite', 'fungal']
 
+  # Protocol parameters of each evaluator, keyed as in EVALUATORS
   _softParams = {'Vaxijen2': ['vaxi2Target'],
                  'Vaxijen3': [],
-                 'AllerTop': [],
-                 'AllergenFP': [],
+                 'AllerTop2': [],
+                 'AllergenFP1': [],
                  }
 
   def __init__(self, **kwargs):
@@ -63,6 +64,10 @@ class ProtDDGEvaluations(EMProtocol):
     aGroup.addParam('vaxi2Target', params.EnumParam, choices=self._vaxiTargets, default=0,
                     label='Vaxijen2 target: ', condition=f'{allCond} and chooseDDGEvaluator==0',
                     help='Target type for the Vaxijen2 epitopen evaluation')
+    aGroup.addParam('vaxi2Sweep', params.BooleanParam, default=False,
+                    label='Sweep all Vaxijen2 targets: ', condition=f'{allCond} and chooseDDGEvaluator==0',
+                    help='Evaluate the epitopes against all the Vaxijen2 targets, producing one score per target. '
+                         'The targets are submitted concurrently, sharing the input files and browser sessions')
     return aGroup
 
   def _defineParams(self, form):
@@ -85,6 +90,13 @@ class ProtDDGEvaluations(EMProtocol):
                     label='Evaluators summary: ',
                     help='Summary of the epitope evaluations that will be performed')
 
+    form.addParam('memoryBudget', params.IntParam, default=1024, expertLevel=params.LEVEL_ADVANCED,
+                  label='Scores memory budget (MB): ',
+                  help='Maximum memory used to keep the evaluation scores. Beyond it, they are stored in disk')
+    form.addParam('exportMetrics', params.BooleanParam, default=False, expertLevel=params.LEVEL_ADVANCED,
+                  label='Export live metrics: ',
+                  help='Periodically write the evaluation metrics (throughput, pending chunks, server latency, '
+                       'errors...) in Prometheus text format to ddg_metrics.prom in the protocol directory')
     form.addParallelSection(threads=4, mpi=1)
 
 
@@ -92,17 +104,25 @@ class ProtDDGEvaluations(EMProtocol):
     self._insertFunctionStep(self.evaluationStep)
 
   def evaluationStep(self):
+    from ..utils import ScoreMatrix
     nt = self.numberOfThreads.get()
     sDics = self.getWebEvaluatorDics()
     sequences = self.getInputSequences()
 
-    epiDic = ddgPlugin.performEvaluations(sequences, sDics, nt, ddgPlugin.getBrowserData())
-    print(epiDic)
+    evalKeys = list(ddgPlugin.getRegisteredEvalDics(sDics))
+    scoreMatrix = ScoreMatrix.empty(list(sequences), evalKeys, memoryBudget=self.memoryBudget.get() * 1024 ** 2,
+                                    spillDir=self._getTmpPath())
+    metricsFile = self.getMetricsFile() if self.exportMetrics.get() else None
+    for evalKey, seqIds, scores in ddgPlugin.iterEvaluations(sequences, sDics, nt, ddgPlugin.getBrowserData(),
+                                                             metricsFile=metricsFile,
+                                                             metricsLabels={'protocol': self.getObjId()}):
+      scoreMatrix.setScores(evalKey, seqIds, scores)
+    scoreMatrix.save(self.getScoreMatrixFile())
 
     outROIs = SetOfSequenceROIs(filename=self._getPath('sequenceROIs.sqlite'))
     for i, roi in enumerate(self.inputROIs.get()):
-      for (evalKey, softName), scores in epiDic.items():
-        setattr(roi, evalKey, params.Float(scores[i]))
+      for j, evalKey in enumerate(evalKeys):
+        setattr(roi, evalKey, params.Float(scoreMatrix.scores[i, j]))
       outROIs.append(roi)
 
     if len(outROIs) > 0:
@@ -110,6 +130,12 @@ class ProtDDGEvaluations(EMProtocol):
 
 
   ##################### UTILS #####################
+  def getScoreMatrixFile(self):
+    return self._getPath('scoreMatrix.npz')
+
+  def getMetricsFile(self):
+    return self._getPath('ddg_metrics.prom')
+
   def getInputSequences(self):
     seqs = {}
     for roi in self.inputROIs.get():
@@ -124,6 +150,9 @@ class ProtDDGEvaluations(EMProtocol):
     sDic = {sName: {'software': soft}}
     for paramName in self._softParams[soft]:
       sDic[sName].update({paramName: self.getParamValue(paramName)})
+    if soft == 'Vaxijen2' and self.vaxi2Sweep.get():
+      # A list of values is swept by the evaluation, with one score per value
+      sDic[sName]['vaxi2Target'] = list(self._vaxiTargets)
     return sDic
 
   def parseElementsDic(self):
@@ -156,6 +185,7 @@ class ProtDDGEvaluations(EMProtocol):
     ''' Returns the selector dictionary with the parameter names expected by the web server
     :return: dic, {selName: {software: softName, paramName: paramValue}} with the webserver chosen parameters
     '''
+    from ..utils import mapEvalParamNames
     sDic = self.parseElementsDic()
     wsDic = mapEvalParamNames(sDic)
     return wsDic
\ No newline at end of file
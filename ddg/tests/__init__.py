@@ -25,3 +25,8 @@
 # **************************************************************************
 
 from ddg.tests.test_ddg_evaluation import *
+from ddg.tests.test_ddg_import import *
+from ddg.tests.test_ddg_scores import *
+from ddg.tests.test_ddg_utils import *
+from ddg.tests.test_ddg_tuning import *
+from ddg.tests.test_ddg_metrics import *
\ No newline at end of file
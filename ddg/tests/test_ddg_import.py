@@ -0,0 +1,52 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307 USA
+# *
+# * All comments concerning this program package may be sent to the
+# * e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import sys, json, subprocess, unittest
+
+# Minimum bound (seconds) for the plugin import time, so a very fast baseline does not make the test flaky
+MIN_IMPORT_BOUND = 0.5
+
+# The plugin modules loaded in the protocols and wizards discovery are imported on top of their pwchem counterparts,
+# whose import time is used as the baseline of the machine speed
+IMPORT_SCRIPT = '''
+import sys, json, time
+start = time.time()
+import pwchem, pwchem.protocols, pwchem.wizards
+baseline = time.time() - start
+start = time.time()
+import ddg, ddg.protocols, ddg.wizards
+print(json.dumps({'time': time.time() - start, 'baseline': baseline, 'utils': 'ddg.utils' in sys.modules}))
+'''
+
+class TestDDGImport(unittest.TestCase):
+	def test(self):
+		# Fresh interpreter so the modules imported by other tests do not interfere
+		out = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], capture_output=True, text=True, check=True)
+		importData = json.loads(out.stdout.strip().split('\n')[-1])
+		print(f'DDG plugin import time: {importData["time"]:.3f} s (pwchem: {importData["baseline"]:.3f} s)')
+
+		self.assertFalse(importData['utils'], 'ddg.utils should only be imported when the evaluations are used')
+		self.assertLess(importData['time'], max(importData['baseline'], MIN_IMPORT_BOUND))
@@ -0,0 +1,86 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307 USA
+# *
+# * All comments concerning this program package may be sent to the
+# * e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os, tempfile, threading, unittest
+
+from ..utils.metrics import MetricsRegistry, MetricsWriter, getLocalMetrics, popLocalMetrics, TIME_BUCKETS
+
+class TestMetrics(unittest.TestCase):
+	def testMerge(self):
+		workerMetrics = MetricsRegistry()
+		workerMetrics.inc('ddg_requests_total', software='Vaxijen3', status='ok')
+		workerMetrics.observe('ddg_request_seconds', 3, software='Vaxijen3')
+
+		metrics = MetricsRegistry()
+		metrics.inc('ddg_requests_total', 2, software='Vaxijen3', status='ok')
+		metrics.observe('ddg_request_seconds', 100, software='Vaxijen3')
+		metrics.merge(workerMetrics.export())
+
+		self.assertEqual(metrics.counters[('ddg_requests_total', (('software', 'Vaxijen3'), ('status', 'ok')))], 3)
+		buckets, total, count = metrics.histograms[('ddg_request_seconds', (('software', 'Vaxijen3'), ))]
+		self.assertEqual((total, count), (103, 2))
+		self.assertEqual(buckets, [int(3 <= bound) + int(100 <= bound) for bound in TIME_BUCKETS])
+
+	def testPrometheusFormat(self):
+		metrics = MetricsRegistry()
+		metrics.inc('ddg_requests_total', software='Vaxijen3', status='error')
+		metrics.setGauge('ddg_chunks_pending', 4)
+		metrics.observe('ddg_parse_seconds', 0.2, software='Vaxijen3')
+		lines = metrics.toPrometheus({'protocol': 'a"b'}).splitlines()
+
+		self.assertIn('# TYPE ddg_requests_total counter', lines)
+		self.assertIn('ddg_requests_total{protocol="a\\"b",software="Vaxijen3",status="error"} 1', lines)
+		self.assertIn('# TYPE ddg_chunks_pending gauge', lines)
+		self.assertIn('ddg_chunks_pending{protocol="a\\"b"} 4', lines)
+		self.assertIn('# TYPE ddg_parse_seconds histogram', lines)
+		self.assertIn(f'ddg_parse_seconds_bucket{{protocol="a\\"b",software="Vaxijen3",le="{TIME_BUCKETS[0]}"}} 1', lines)
+		self.assertIn('ddg_parse_seconds_bucket{protocol="a\\"b",software="Vaxijen3",le="+Inf"} 1', lines)
+		self.assertIn('ddg_parse_seconds_count{protocol="a\\"b",software="Vaxijen3"} 1', lines)
+
+	def testLocalMetrics(self):
+		popLocalMetrics()
+		getLocalMetrics().inc('ddg_requests_total')
+		threadMetrics = []
+		thread = threading.Thread(target=lambda: threadMetrics.append(popLocalMetrics()))
+		thread.start()
+		thread.join()
+		# Each thread records its own metrics, which are reset once popped
+		self.assertEqual(threadMetrics[0]['counters'], [])
+		self.assertEqual(popLocalMetrics()['counters'], [['ddg_requests_total', {}, 1]])
+		self.assertEqual(popLocalMetrics()['counters'], [])
+
+	def testWriter(self):
+		metrics = MetricsRegistry()
+		with tempfile.TemporaryDirectory() as tmpDir:
+			metricsFile = os.path.join(tmpDir, 'ddg_metrics.prom')
+			writer = MetricsWriter(metrics, metricsFile, interval=60)
+			writer.start()
+			metrics.inc('ddg_chunks_completed_total')
+			writer.stop()
+			with open(metricsFile) as f:
+				self.assertIn('ddg_chunks_completed_total 1', f.read())
+			self.assertEqual(os.listdir(tmpDir), ['ddg_metrics.prom'])
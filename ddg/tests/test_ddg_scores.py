@@ -0,0 +1,100 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307 USA
+# *
+# * All comments concerning this program package may be sent to the
+# * e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os, tempfile, unittest, warnings
+
+import numpy as np
+
+from ..utils.scores import ScoreMatrix
+
+ROI_IDS = [3, 1, 2, 5]
+
+class TestScoreMatrix(unittest.TestCase):
+	def getMatrix(self):
+		# Columns: continuous scores with a missing value, binary scores (e.g: AllerTop) and all missing scores
+		scores = [[0.5, 1, np.nan],
+							[np.nan, 0, np.nan],
+							[1.5, 1, np.nan],
+							[-0.5, 0, np.nan]]
+		return ScoreMatrix(ROI_IDS, ['eval1', 'eval2', 'eval3'], scores)
+
+	def testNormalize(self):
+		scoreMatrix = self.getMatrix()
+		with warnings.catch_warnings():
+			warnings.simplefilter('error')
+			minmax = scoreMatrix.normalize('minmax')
+			zscore = scoreMatrix.normalize('zscore')
+			ranks = scoreMatrix.normalize('rank')
+
+		np.testing.assert_allclose(minmax[:, 0], [0.5, np.nan, 1, 0])
+		np.testing.assert_allclose(np.nanmean(zscore[:, :2], axis=0), [0, 0], atol=1e-12)
+		self.assertTrue(np.isnan(minmax[:, 2]).all() and np.isnan(ranks[:, 2]).all())
+
+		np.testing.assert_allclose(ranks[:, 0], [0.5, np.nan, 1, 0])
+		# Tied scores get the same (average) rank, whatever their order
+		np.testing.assert_allclose(ranks[:, 1], [5 / 6, 1 / 6, 5 / 6, 1 / 6])
+		with self.assertRaises(ValueError):
+			scoreMatrix.normalize('unknown')
+
+	def testConsensus(self):
+		scoreMatrix = self.getMatrix()
+		consensus = scoreMatrix.consensus()
+		# Missing scores are ignored: ROI 1 consensus only uses eval2
+		np.testing.assert_allclose(consensus, [0.75, 0, 1, 0])
+		np.testing.assert_allclose(scoreMatrix.consensus(weights={'eval1': 1}), [0.5, np.nan, 1, 0])
+
+	def testTopK(self):
+		scoreMatrix = self.getMatrix()
+		topIds, topScores = scoreMatrix.topK(2)
+		np.testing.assert_array_equal(topIds, [2, 3])
+		np.testing.assert_allclose(topScores, [1, 0.75])
+
+		topIds, _ = scoreMatrix.topK(10, weights={'eval1': 1})
+		# ROIs with no score are ranked last
+		self.assertEqual(topIds[-1], 1)
+		self.assertEqual(len(scoreMatrix.topK(0)[0]), 0)
+
+	def testSetScores(self):
+		scoreMatrix = ScoreMatrix.empty(ROI_IDS, ['eval1'])
+		scoreMatrix.setScores('eval1', [5, 3], [0.1, 0.2])
+		np.testing.assert_allclose(scoreMatrix.getColumn('eval1'), [0.2, np.nan, np.nan, 0.1])
+		with self.assertRaises(KeyError):
+			scoreMatrix.setScores('eval1', [4], [0.3])
+
+	def testSaveLoad(self):
+		scoreMatrix = self.getMatrix()
+		with tempfile.TemporaryDirectory() as tmpDir:
+			loaded = ScoreMatrix.load(scoreMatrix.save(os.path.join(tmpDir, 'scoreMatrix.npz')))
+
+			# Over the memory budget, the scores are kept in a file
+			spilled = ScoreMatrix.empty(ROI_IDS, ['eval1'], memoryBudget=0, spillDir=tmpDir)
+			self.assertEqual(len(os.listdir(tmpDir)), 2)
+			self.assertTrue(np.isnan(spilled.scores).all())
+
+		np.testing.assert_array_equal(loaded.roiIds, scoreMatrix.roiIds)
+		self.assertEqual(loaded.evalKeys, scoreMatrix.evalKeys)
+		np.testing.assert_array_equal(loaded.scores, scoreMatrix.scores)
@@ -0,0 +1,73 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307 USA
+# *
+# * All comments concerning this program package may be sent to the
+# * e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os, tempfile, unittest
+
+from ..utils.tuning import recordRequest, RunHistory, DEFAULT_CHUNK_SIZE, MAX_CHUNK_SIZE
+
+SOFT_NAME = 'Vaxijen3'
+
+class TestRunHistory(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.TemporaryDirectory()
+		self.historyFile = os.path.join(self.tmpDir.name, 'history.jsonl')
+
+	def tearDown(self):
+		self.tmpDir.cleanup()
+
+	def recordRequests(self, nRequests, nErrors=0, jobs=1, nSeqs=10):
+		for i in range(nRequests):
+			recordRequest(self.historyFile, SOFT_NAME, nSeqs, 1 + nSeqs * 0.1, error=i < nErrors, jobs=jobs)
+		return RunHistory(self.historyFile)
+
+	def testChunkSize(self):
+		history = RunHistory(None)
+		# Without history or server limit, the input is still split in bounded chunks
+		self.assertEqual(history.suggestChunkSize(SOFT_NAME, 1000000), DEFAULT_CHUNK_SIZE)
+		self.assertEqual(history.suggestChunkSize(SOFT_NAME, 1000000, maxChunk=10), 10)
+		self.assertEqual(history.suggestChunkSize(SOFT_NAME, 3), 3)
+
+		# Successful chunk sizes are doubled up to the limit
+		history = self.recordRequests(10, nSeqs=20)
+		self.assertEqual(history.suggestChunkSize(SOFT_NAME, 1000000), 40)
+		history = self.recordRequests(10, nSeqs=MAX_CHUNK_SIZE)
+		self.assertEqual(history.suggestChunkSize(SOFT_NAME, 1000000), MAX_CHUNK_SIZE)
+
+	def testJobsFromTasks(self):
+		history = RunHistory(None)
+		# A single evaluator split in many tasks uses all the requested jobs
+		self.assertEqual(history.suggestJobs([SOFT_NAME], nTasks=20, jobs=8), 8)
+		self.assertEqual(history.suggestJobs([SOFT_NAME], nTasks=3, jobs=8), 3)
+		self.assertEqual(history.suggestJobs([SOFT_NAME], nTasks=0, jobs=8), 1)
+
+	def testJobsFromErrors(self):
+		self.recordRequests(10, jobs=4)
+		history = self.recordRequests(10, nErrors=5, jobs=8)
+		# Parallelism levels that have been failing recently are avoided, the working ones are kept
+		self.assertEqual(history.suggestJobs([SOFT_NAME], nTasks=20, jobs=8), 4)
+		self.assertEqual(history.suggestJobs([SOFT_NAME], nTasks=20, jobs=4), 4)
+		self.assertEqual(history.suggestJobs(['AllerTop2'], nTasks=20, jobs=8), 8)
@@ -0,0 +1,188 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307 USA
+# *
+# * All comments concerning this program package may be sent to the
+# * e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from ..constants import STD_RESIDUES
+from ..utils import utils
+from ..utils.utils import validateSequences, fillMissingScores, runSeleniumChunks, evaluateChunk, MAX_RETRIES, \
+	expandEvalSweeps, getEvaluatorSoftData, mapEvalParamNames
+
+VALID_DATA = {'alphabet': STD_RESIDUES, 'minLength': 2, 'maxLength': 10}
+
+class TestSequenceValidation(unittest.TestCase):
+	def testValidate(self):
+		seqs = ['ACDEF', 'acdef', 'AC-DE', 'ACDE*', 'A', 'ACDEFGHIKLM', '', 'ACXDE', 'AßCD', 'ACDÉF', 'KLMNP']
+		valid = validateSequences(seqs, VALID_DATA)
+		# Lowercase residues are admitted. Gaps, stops, non-standard and non ascii residues or lengths out of the
+		# limits are not, and the rejections do not shift the checks of the next sequences
+		np.testing.assert_array_equal(valid, [True, True, False, False, False, False, False, False, False, False, True])
+
+	def testValidateEmpty(self):
+		self.assertEqual(len(validateSequences([], VALID_DATA)), 0)
+		np.testing.assert_array_equal(validateSequences(['', 'AC'], {}), [False, True])
+
+	def testFillMissing(self):
+		validMask = np.array([True, False, True, False])
+		outDic = fillMissingScores({'Score': [0.5, -0.2]}, validMask)
+		np.testing.assert_allclose(outDic['Score'], [0.5, np.nan, -0.2, np.nan])
+		self.assertTrue(np.isnan(fillMissingScores({'Score': []}, np.zeros(2, dtype=bool))['Score']).all())
+
+
+SOFT_DATA = {'softName': 'Vaxijen3', 'multi': True, 'seqFormat': 'fastaString', 'seqName': 'sequence', 'params': {}}
+
+class FakeDriver:
+	'''Driver emulating a server that scores each sequence with its length, echoing the fasta sequence names'''
+	def __init__(self, dropSeqs=(), failures=0, echoNames=True):
+		self.dropSeqs, self.failures, self.echoNames = dropSeqs, failures, echoNames
+		self.requests = []
+
+	def parse(self, driver):
+		if self.failures > 0:
+			self.failures -= 1
+			raise TimeoutError('Results not found')
+		records = [record.split('\n') for record in self.requests[-1].split('>')[1:]]
+		records = [(name, seq) for name, seq, _ in records if seq not in self.dropSeqs]
+		resDic = {'Score': [float(len(seq)) for _, seq in records]}
+		if self.echoNames:
+			resDic['ID'] = [int(name[3:]) - 1 for name, _ in records]
+		return resDic
+
+
+def fakeRequest(seqKeys, driver, softData):
+	driver.requests.append(seqKeys[softData['seqName']])
+	return driver
+
+
+@mock.patch.object(utils, 'RETRY_BACKOFF', 0)
+@mock.patch.object(utils, 'performRequest', fakeRequest)
+class TestSeleniumChunks(unittest.TestCase):
+	seqDic = {f'roi{i}': 'ACDEFGHIKL'[:i + 2] for i in range(6)}
+
+	def runChunks(self, driver, maxChunk=None):
+		return runSeleniumChunks(self.seqDic, SOFT_DATA, driver, driver.parse, runData={'maxChunk': maxChunk})
+
+	def testAllReturned(self):
+		driver = FakeDriver()
+		outDic = self.runChunks(driver, maxChunk=4)
+		self.assertEqual(outDic, {'Score': [2, 3, 4, 5, 6, 7]})
+		self.assertEqual(len(driver.requests), 2)
+
+	def testResubmitMissing(self):
+		# The server does not return the records of some sequences: only those are resubmitted
+		driver = FakeDriver(dropSeqs=['ACDE', 'ACDEFG'])
+		with mock.patch.object(utils.time, 'sleep') as sleepMock:
+			outDic = self.runChunks(driver)
+		np.testing.assert_array_equal(outDic['Score'], [2, 3, np.nan, 5, np.nan, 7])
+		self.assertEqual(driver.requests[1], '>seq1\nACDE\n>seq2\nACDEFG\n')
+		self.assertEqual(len(driver.requests), 2 + MAX_RETRIES)
+		# The resubmissions returning none of the records are new attempts, with backoff
+		self.assertEqual(sleepMock.call_count, MAX_RETRIES)
+
+	def testBisection(self):
+		# Without the records names, the chunk is split to isolate the sequence not returned
+		driver = FakeDriver(dropSeqs=['ACDE'], echoNames=False)
+		outDic = self.runChunks(driver)
+		np.testing.assert_array_equal(outDic['Score'], [2, 3, np.nan, 5, 6, 7])
+
+	def testRetry(self):
+		driver = FakeDriver(failures=2)
+		self.assertEqual(self.runChunks(driver), {'Score': [2, 3, 4, 5, 6, 7]})
+		self.assertEqual(len(driver.requests), 3)
+
+	def testMissingAfterRetries(self):
+		driver = FakeDriver(failures=MAX_RETRIES + 1)
+		outDic = self.runChunks(driver)
+		self.assertTrue(np.isnan(outDic['Score']).all())
+		self.assertEqual(len(driver.requests), MAX_RETRIES + 1)
+
+
+@mock.patch.object(utils, 'RETRY_BACKOFF', 0)
+@mock.patch.object(utils, 'dropWorkerDriver', mock.Mock())
+@mock.patch.object(utils, 'getWorkerDriver', mock.Mock())
+class TestEvaluateChunk(unittest.TestCase):
+	seqDic = {'roi1': 'ACDE', 'roi2': 'KLMN'}
+
+	def testBrowserErrors(self):
+		# Browser, connection or daemon failures are retried, and the chunk gets missing scores if they persist
+		with mock.patch.object(utils, 'callEvaluator', mock.Mock(side_effect=ConnectionRefusedError())) as callMock:
+			start, scoreDic, _ = evaluateChunk('eval1', 'Vaxijen3', 4, self.seqDic, {'eval1': {}})
+		self.assertEqual(callMock.call_count, MAX_RETRIES + 1)
+		self.assertEqual(start, 4)
+		self.assertTrue(np.isnan(scoreDic['eval1']).all())
+
+	def testBrokenDriver(self):
+		# A dead driver makes the whole chunk fail at once, so it is discarded and the chunk evaluated with a new one
+		deadDriver, newDriver = FakeDriver(), FakeDriver()
+
+		def request(seqKeys, driver, softData):
+			if driver is deadDriver:
+				raise ConnectionRefusedError()
+			return fakeRequest(seqKeys, driver, softData)
+
+		parse = lambda driver: {'Score': [float(len(driver.requests[-1]))]}
+		with mock.patch.object(utils, 'getWorkerDriver', mock.Mock(side_effect=[deadDriver, newDriver])), \
+				mock.patch.object(utils, 'dropWorkerDriver', mock.Mock()) as dropMock, \
+				mock.patch.object(utils, 'performRequest', request), mock.patch.object(utils, 'parseAllerDDG', parse):
+			_, scoreDic, _ = evaluateChunk('eval1', 'AllerTop2', 0, self.seqDic, {'eval1': {}})
+
+		dropMock.assert_called_once()
+		self.assertEqual(list(scoreDic['eval1']), [4, 4])
+		self.assertEqual(len(newDriver.requests), 2)
+
+	def testProgrammingErrors(self):
+		with mock.patch.object(utils, 'callEvaluator', mock.Mock(side_effect=KeyError('Score'))) as callMock:
+			with self.assertRaises(KeyError):
+				evaluateChunk('eval1', 'Vaxijen3', 0, self.seqDic, {'eval1': {}})
+		self.assertEqual(callMock.call_count, 1)
+
+
+class TestParameterSweeps(unittest.TestCase):
+	def getVariantParams(self, evalDics):
+		variantParams = {}
+		for variantKey, variantDic in expandEvalSweeps(evalDics)['Vaxijen2-1'].items():
+			data = {paramName: value for paramName, value in variantDic.items() if paramName != 'software'}
+			variantParams[variantKey] = getEvaluatorSoftData('Vaxijen2', data)['params']
+		return variantParams
+
+	def testVariantParams(self):
+		# Each variant sets its own value in the web form element
+		evalDics = {'Vaxijen2-1': {'software': 'Vaxijen2', 'vaxi2Target': ['bacteria', 'virus']}}
+		self.assertEqual(self.getVariantParams(evalDics),
+										 {'Vaxijen2-1_bacteria': {'Target': 'Bacteria'}, 'Vaxijen2-1_virus': {'Target': 'Virus'}})
+
+		# Same web form parameters if the protocol ones are mapped first
+		self.assertEqual(list(self.getVariantParams(mapEvalParamNames(evalDics)).values()),
+										 [{'Target': 'Bacteria'}, {'Target': 'Virus'}])
+
+	def testSingleEvaluation(self):
+		evalDics = {'Vaxijen2-1': {'software': 'Vaxijen2', 'vaxi2Target': 'tumor'}}
+		self.assertEqual(self.getVariantParams(evalDics), {'Vaxijen2-1': {'Target': 'Tumour'}})
+		self.assertEqual(getEvaluatorSoftData('Vaxijen2')['params'], {'Target': 'Bacteria'})
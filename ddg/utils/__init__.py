@@ -1 +1,3 @@
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .scores import ScoreMatrix
+from .tuning import RunHistory
\ No newline at end of file
@@ -0,0 +1,213 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Local daemon keeping a bounded set of warm browser sessions shared by all the DDG evaluations of the workstation.
+Jobs are received as json lines over a Unix socket, so any Scipion process can submit them.
+
+Launch it from the Scipion environment with:
+    scipion3 python -m ddg.utils.daemon --socket /tmp/ddg_browser.sock --sessions 4 --maxMemory 4000
+and set DDG_DAEMON_SOCKET = /tmp/ddg_browser.sock in the scipion.conf file.
+"""
+
+import os, json, time, queue, socket, argparse, socketserver
+
+MEMORY_WAIT = 5       # Seconds to wait before checking again the memory when the limit is reached
+CONNECT_TIMEOUT = 5   # Seconds to wait for the daemon to accept a connection
+
+class DaemonJobError(RuntimeError):
+  '''Failure of a job reported by the browser daemon'''
+
+
+def sendDaemonJob(socketFile, job, timeout):
+  '''Sends an evaluation job to the browser daemon and waits for its result
+  - socketFile: str, Unix socket where the daemon listens
+  - job: dic, {'softName': softName, 'sequences': {seqId: seqString}, 'browserData': {}, 'data': {}, 'runData': {}}
+  For parameter sweeps, 'variants': {variantKey: data} replaces 'data'
+  - timeout: float, seconds to wait for the result before considering the daemon hung. It must bound the longest
+  time the job can legitimately take (see utils.getJobTimeout), or the job would be resubmitted while still running
+  Returns the evaluation result dic {'Score': [sc1, ...]} ({variantKey: {'Score': [sc1, ...]}} for sweeps)
+  '''
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    sock.settimeout(CONNECT_TIMEOUT)
+    sock.connect(socketFile)
+    sock.settimeout(timeout)
+    sock.sendall((json.dumps(job) + '\n').encode())
+    sock.shutdown(socket.SHUT_WR)
+    with sock.makefile('r') as f:
+      response = json.loads(f.readline())
+
+  if 'error' in response:
+    raise DaemonJobError(f'Browser daemon job failed: {response["error"]}')
+  return response
+
+
+def isDaemonAvailable(socketFile):
+  '''Returns whether a daemon is accepting connections in the socket. The socket file alone is not enough: it is
+  left behind if the daemon is killed'''
+  if not socketFile or not os.path.exists(socketFile):
+    return False
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.settimeout(CONNECT_TIMEOUT)
+      sock.connect(socketFile)
+    return True
+  except OSError:
+    return False
+
+
+def getTreeMemory(pid):
+  '''Returns the resident memory (MB) of a process and all its descendants, read from /proc'''
+  children = {}
+  for procDir in os.listdir('/proc'):
+    if procDir.isdigit():
+      try:
+        with open(f'/proc/{procDir}/stat') as f:
+          ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(procDir))
+      except (OSError, IndexError, ValueError):
+        continue
+
+  memory, pids = 0, [pid]
+  while pids:
+    curPid = pids.pop()
+    pids += children.get(curPid, [])
+    try:
+      with open(f'/proc/{curPid}/status') as f:
+        for line in f:
+          if line.startswith('VmRSS:'):
+            memory += int(line.split()[1]) / 1024
+    except OSError:
+      continue
+  return memory
+
+
+class BrowserPool:
+  '''Bounded set of warm selenium drivers. The number of sessions limits the jobs running at once and the sessions
+  are restarted when the memory of the daemon and its browsers goes beyond maxMemory (MB)'''
+  def __init__(self, browserData, nSessions, maxMemory=None):
+    from .utils import getDriver
+    self.browserData, self.maxMemory = browserData, maxMemory
+    self.sessions = queue.Queue()
+    for _ in range(nSessions):
+      self.sessions.put(getDriver(browserData))
+
+  def overMemory(self):
+    return self.maxMemory and getTreeMemory(os.getpid()) > self.maxMemory
+
+  def restartSession(self, driver):
+    from .utils import getDriver
+    try:
+      driver.quit()
+    except Exception:
+      pass
+    return getDriver(self.browserData)
+
+  def acquire(self):
+    driver = self.sessions.get()
+    if self.overMemory():
+      driver = self.restartSession(driver)
+      while self.overMemory():
+        print(f'Browser daemon over the memory limit ({self.maxMemory} MB), waiting')
+        time.sleep(MEMORY_WAIT)
+    return driver
+
+  def release(self, driver, failed=False):
+    if failed or self.overMemory():
+      driver = self.restartSession(driver)
+    self.sessions.put(driver)
+
+  def close(self):
+    while not self.sessions.empty():
+      self.sessions.get().quit()
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    from .utils import callEvaluator, callSweepEvaluator
+    from .metrics import popLocalMetrics
+    line = self.rfile.readline()
+    if not line.strip():
+      # Availability checks connect without sending any job
+      return
+    job = json.loads(line)
+    driver, failed = self.server.browserPool.acquire(), False
+    try:
+      if 'variants' in job:
+        response = callSweepEvaluator(job['softName'], job['sequences'], job['variants'], job.get('browserData', {}),
+                                      job.get('runData', {}), driver=driver)
+      else:
+        response = callEvaluator(job['softName'], job['sequences'], job.get('browserData', {}),
+                                 job.get('data', {}), job.get('runData', {}), driver=driver)
+    except Exception as e:
+      response, failed = {'error': f'{type(e).__name__}: {e}'}, True
+    finally:
+      self.server.browserPool.release(driver, failed)
+    # Metrics recorded by this job thread, sent back to be exported by the client
+    response['metrics'] = popLocalMetrics()
+    self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class BrowserDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, socketFile, browserPool):
+    if os.path.exists(socketFile):
+      os.remove(socketFile)
+    super().__init__(socketFile, DaemonHandler)
+    os.chmod(socketFile, 0o600)
+    self.socketFile, self.browserPool = socketFile, browserPool
+
+  def server_close(self):
+    super().server_close()
+    self.browserPool.close()
+    if os.path.exists(self.socketFile):
+      os.remove(self.socketFile)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Shared browser sessions daemon for the DDG evaluations')
+  parser.add_argument('--socket', required=True, help='Unix socket where the daemon listens for jobs')
+  parser.add_argument('--sessions', type=int, default=2, help='Number of browser sessions (jobs running at once)')
+  parser.add_argument('--maxMemory', type=float, default=None,
+                      help='Memory limit (MB) of the daemon and its browsers. Sessions are restarted beyond it')
+  parser.add_argument('--browser', default='Chrome', help='Browser to use (Chrome or Firefox)')
+  parser.add_argument('--browserPath', default='', help='Path to the browser executable')
+  args = parser.parse_args()
+
+  browserPool = BrowserPool({'name': args.browser, 'path': args.browserPath}, args.sessions, args.maxMemory)
+  server = BrowserDaemon(args.socket, browserPool)
+  print(f'DDG browser daemon listening in {args.socket} with {args.sessions} sessions')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+if __name__ == '__main__':
+  main()
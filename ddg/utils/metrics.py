@@ -0,0 +1,151 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Counters, gauges and histograms of the evaluations, exported in the Prometheus text format.
+The metrics are recorded in a registry local to each thread (pool workers, daemon jobs), returned with the results and
+merged in the registry of the process writing the metrics file.
+"""
+
+import os, threading
+
+# Histogram buckets (seconds) for the requests, parsing and chunks durations
+TIME_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+_localData = threading.local()
+
+class MetricsRegistry:
+  '''Thread safe store of counters, gauges and histograms, identified by their name and labels'''
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters, self.gauges, self.histograms = {}, {}, {}
+
+  def inc(self, name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def setGauge(self, name, value, **labels):
+    with self.lock:
+      self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+  def observe(self, name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      buckets, total, count = self.histograms.get(key, ([0] * len(TIME_BUCKETS), 0, 0))
+      buckets = [bCount + (value <= bound) for bCount, bound in zip(buckets, TIME_BUCKETS)]
+      self.histograms[key] = (buckets, total + value, count + 1)
+
+  def export(self):
+    '''Returns the counters and histograms in a serializable form (lists), to be merged in other registry'''
+    with self.lock:
+      return {'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+              'histograms': [[name, dict(labels), list(buckets), total, count]
+                             for (name, labels), (buckets, total, count) in self.histograms.items()]}
+
+  def merge(self, exported):
+    '''Adds the counters and histograms exported from other registry'''
+    for name, labels, value in exported.get('counters', []):
+      self.inc(name, value, **labels)
+    with self.lock:
+      for name, labels, buckets, total, count in exported.get('histograms', []):
+        key = (name, tuple(sorted(labels.items())))
+        prevBuckets, prevTotal, prevCount = self.histograms.get(key, ([0] * len(TIME_BUCKETS), 0, 0))
+        self.histograms[key] = ([b1 + b2 for b1, b2 in zip(prevBuckets, buckets)],
+                                prevTotal + total, prevCount + count)
+
+  def toPrometheus(self, constLabels={}):
+    '''Returns the metrics in the Prometheus text exposition format'''
+    lines = []
+    with self.lock:
+      for metricType, metrics in [('counter', self.counters), ('gauge', self.gauges)]:
+        for name in sorted({name for name, _ in metrics}):
+          lines.append(f'# TYPE {name} {metricType}')
+          for (mName, labels), value in metrics.items():
+            if mName == name:
+              lines.append(f'{name}{formatLabels(labels, constLabels)} {value}')
+
+      for name in sorted({name for name, _ in self.histograms}):
+        lines.append(f'# TYPE {name} histogram')
+        for (mName, labels), (buckets, total, count) in self.histograms.items():
+          if mName == name:
+            for bound, bCount in zip(TIME_BUCKETS, buckets):
+              lines.append(f'{name}_bucket{formatLabels(labels, constLabels, le=bound)} {bCount}')
+            lines.append(f'{name}_bucket{formatLabels(labels, constLabels, le="+Inf")} {count}')
+            lines.append(f'{name}_sum{formatLabels(labels, constLabels)} {total}')
+            lines.append(f'{name}_count{formatLabels(labels, constLabels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def formatLabels(labels, constLabels={}, **extraLabels):
+  allLabels = {**constLabels, **dict(labels), **extraLabels}
+  if not allLabels:
+    return ''
+  labelStrs = [f'{lName}="{escapeLabel(lValue)}"' for lName, lValue in allLabels.items()]
+  return '{' + ','.join(labelStrs) + '}'
+
+
+def escapeLabel(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def getLocalMetrics():
+  '''Returns the metrics registry of the current thread'''
+  if not hasattr(_localData, 'registry'):
+    _localData.registry = MetricsRegistry()
+  return _localData.registry
+
+
+def popLocalMetrics():
+  '''Returns the exported metrics of the current thread and resets them'''
+  registry = getLocalMetrics()
+  _localData.registry = MetricsRegistry()
+  return registry.export()
+
+
+class MetricsWriter(threading.Thread):
+  '''Thread periodically writing the metrics of a registry to a Prometheus text file (e.g: for the node exporter
+  textfile collector). The file is replaced atomically, so it is never read half written'''
+  def __init__(self, registry, filename, interval=15, constLabels={}):
+    super().__init__(daemon=True)
+    self.registry, self.filename, self.interval, self.constLabels = registry, filename, interval, constLabels
+    self.stopEvent = threading.Event()
+
+  def write(self):
+    tmpFile = f'{self.filename}.tmp'
+    with open(tmpFile, 'w') as f:
+      f.write(self.registry.toPrometheus(self.constLabels))
+    os.replace(tmpFile, self.filename)
+
+  def run(self):
+    self.write()
+    while not self.stopEvent.wait(self.interval):
+      self.write()
+
+  def stop(self):
+    self.stopEvent.set()
+    self.join()
+    self.write()
@@ -0,0 +1,184 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import tempfile, warnings
+
+import numpy as np
+
+NORM_METHODS = ['minmax', 'zscore', 'rank']
+
+class ScoreMatrix:
+  '''Stores the scores of several evaluators over a set of ROIs as a 2D float array of shape (nROIs, nEvaluators),
+  indexed by ROI ID. Missing scores are stored as NaN.
+  '''
+  def __init__(self, roiIds, evalKeys, scores=None):
+    self.roiIds = np.asarray(roiIds)
+    self.evalKeys = list(evalKeys)
+    if scores is None:
+      scores = np.full((len(self.roiIds), len(self.evalKeys)), np.nan)
+    self.scores = np.asarray(scores, dtype=float)
+    self._sortIdx = np.argsort(self.roiIds, kind='stable')
+
+  def __len__(self):
+    return len(self.roiIds)
+
+  @classmethod
+  def empty(cls, roiIds, evalKeys, memoryBudget=None, spillDir=None):
+    '''Builds a matrix with all the scores missing, to be filled with setScores.
+    If the scores array is bigger than memoryBudget (bytes), it is stored in a memory mapped file in spillDir, so the
+    memory used does not grow with the number of ROIs
+    '''
+    shape = (len(roiIds), len(evalKeys))
+    if memoryBudget is not None and shape[0] * shape[1] * np.dtype(float).itemsize > memoryBudget:
+      spillFile = tempfile.NamedTemporaryFile(dir=spillDir, prefix='scoreMatrix_', suffix='.npy', delete=False).name
+      scores = np.lib.format.open_memmap(spillFile, mode='w+', dtype=float, shape=shape)
+      scores[:] = np.nan
+    else:
+      scores = None
+    return cls(roiIds, evalKeys, scores)
+
+  @classmethod
+  def fromDic(cls, roiIds, epiDic):
+    '''Builds the matrix from the output of Plugin.performEvaluations
+    - roiIds: list of ROI IDs, in the same order as the scores in epiDic
+    - epiDic: dic, {(evalKey, softwareName): [scores]}
+    '''
+    evalKeys = [evalKey for evalKey, _ in epiDic]
+    scoreMatrix = cls(roiIds, evalKeys)
+    for j, scores in enumerate(epiDic.values()):
+      scoreMatrix.scores[:, j] = np.asarray(scores, dtype=float)
+    return scoreMatrix
+
+  @classmethod
+  def load(cls, filename):
+    '''Loads a score matrix previously written with save'''
+    with np.load(filename, allow_pickle=False) as data:
+      return cls(data['roiIds'], data['evalKeys'].tolist(), data['scores'])
+
+  def save(self, filename):
+    '''Writes the matrix as a compressed columnar npz file (roiIds, evalKeys, scores)'''
+    np.savez_compressed(filename, roiIds=self.roiIds, evalKeys=np.array(self.evalKeys, dtype=str),
+                        scores=self.scores)
+    return filename
+
+  ##################### ACCESS #####################
+  def getRowIndexes(self, roiIds):
+    '''Returns the row indexes of the input ROI IDs, raising a KeyError if any of them is not in the matrix'''
+    roiIds = np.asarray(roiIds)
+    pos = np.searchsorted(self.roiIds, roiIds, sorter=self._sortIdx)
+    pos[pos == len(self.roiIds)] = 0
+    rows = self._sortIdx[pos]
+    if len(rows) > 0 and not np.all(self.roiIds[rows] == roiIds):
+      raise KeyError(f'ROI IDs not found in score matrix: {roiIds[self.roiIds[rows] != roiIds]}')
+    return rows
+
+  def getColumn(self, evalKey):
+    return self.scores[:, self.evalKeys.index(evalKey)]
+
+  def setScores(self, evalKey, roiIds, scores):
+    '''Sets the scores of an evaluator for a subset of ROIs'''
+    self.scores[self.getRowIndexes(roiIds), self.evalKeys.index(evalKey)] = scores
+
+  ##################### RANKING #####################
+  def normalize(self, method='minmax'):
+    '''Returns a copy of the scores normalized per evaluator (column), keeping NaN for the missing values
+    - method: str, one of "minmax" (scaled to [0, 1]), "zscore" or "rank" (average rank of the ROI among the ROIs
+    with a score, scaled to [0, 1]. Tied scores get the same rank)
+    Columns with all the scores missing stay missing
+    '''
+    if method not in NORM_METHODS:
+      raise ValueError(f'Unknown normalization method "{method}". Available: {NORM_METHODS}')
+
+    scores = self.scores
+    with warnings.catch_warnings():
+      # All-NaN columns (e.g: a failed evaluator) give NaN statistics, so their normalized scores stay NaN
+      warnings.simplefilter('ignore', category=RuntimeWarning)
+      if method == 'minmax':
+        mins, maxs = np.nanmin(scores, axis=0), np.nanmax(scores, axis=0)
+        ranges = np.where(maxs > mins, maxs - mins, 1)
+        normScores = (scores - mins) / ranges
+      elif method == 'zscore':
+        means, stds = np.nanmean(scores, axis=0), np.nanstd(scores, axis=0)
+        normScores = (scores - means) / np.where(stds > 0, stds, 1)
+      else:
+        normScores = np.column_stack([averageRanks(column) for column in scores.T]) if scores.size else \
+          np.array(scores, dtype=float)
+    return normScores
+
+  def consensus(self, weights=None, method='minmax'):
+    '''Returns the weighted consensus score of each ROI over the normalized evaluator scores.
+    Missing scores are ignored, so the weights of each ROI are rescaled over its available evaluators.
+    - weights: dic {evalKey: weight} or list of weights in the evalKeys order. Equal weights if None
+    - method: normalization method applied before the consensus (see normalize)
+    '''
+    if weights is None:
+      weights = np.ones(len(self.evalKeys))
+    elif isinstance(weights, dict):
+      weights = np.array([weights.get(evalKey, 0) for evalKey in self.evalKeys], dtype=float)
+    weights = np.asarray(weights, dtype=float)
+
+    normScores = self.normalize(method)
+    present = ~np.isnan(normScores)
+    weightSums = present @ weights
+    with np.errstate(invalid='ignore', divide='ignore'):
+      consScores = np.where(present, normScores, 0) @ weights / weightSums
+    return np.where(weightSums > 0, consScores, np.nan)
+
+  def topK(self, k, weights=None, method='minmax'):
+    '''Returns the IDs and consensus scores of the k best ROIs, sorted by descending consensus.
+    Uses a partial sort so only the selected k ROIs are fully sorted.
+    '''
+    consScores = self.consensus(weights, method)
+    sortScores = np.where(np.isnan(consScores), -np.inf, consScores)
+    k = min(k, len(sortScores))
+    if k <= 0:
+      return self.roiIds[:0], consScores[:0]
+
+    topIdx = np.argpartition(-sortScores, k - 1)[:k]
+    topIdx = topIdx[np.argsort(-sortScores[topIdx], kind='stable')]
+    return self.roiIds[topIdx], consScores[topIdx]
+
+
+def averageRanks(values):
+  '''Returns the ranks of the values scaled to [0, 1], with the average rank for the tied values and NaN for the
+  missing ones'''
+  ranks, present = np.full(len(values), np.nan), ~np.isnan(values)
+  presValues = values[present]
+  if len(presValues) == 0:
+    return ranks
+
+  order = np.argsort(presValues, kind='stable')
+  sortValues = presValues[order]
+  # Ranks of the first and last position of each group of tied values
+  uniqueStarts = np.concatenate([[True], sortValues[1:] != sortValues[:-1]])
+  groupIds = np.cumsum(uniqueStarts) - 1
+  firstRanks = np.flatnonzero(uniqueStarts)
+  lastRanks = np.concatenate([firstRanks[1:], [len(sortValues)]]) - 1
+  presRanks = np.empty(len(presValues))
+  presRanks[order] = ((firstRanks + lastRanks) / 2)[groupIds]
+
+  ranks[present] = presRanks / max(len(presValues) - 1, 1)
+  return ranks
@@ -0,0 +1,183 @@
+# **************************************************************************
+# *
+# * Authors:     Daniel Del Hoyo (ddelhoyo@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os, json, time, math, fcntl
+
+MAX_RECORDS = 200         # Records kept per software in the history file
+MIN_RECORDS = 5           # Records needed before trusting the history of a software
+MAX_ERROR_RATE = 0.1      # Maximum admitted error rate for a chunk size or a parallelism level
+RECENT_TIME = 3600        # Seconds considered to check the recent error rates
+HALF_LIFE = 6 * 3600      # Half life (seconds) of the records weights, the servers latency changes along the day
+MAX_HISTORY_BYTES = 200000  # History file size that triggers its compaction
+DEFAULT_CHUNK_SIZE = 50   # Sequences per request without history of a software
+MAX_CHUNK_SIZE = 1000     # Maximum sequences per request for the servers without a declared limit
+
+
+def recordRequest(historyFile, softName, nSeqs, seconds, error=False, jobs=1):
+  '''Appends the timing of a request to the history file. Safe to call from several processes at once.
+  - historyFile: str, history json lines file. Nothing is recorded if None
+  - softName: str, name of the evaluation software
+  - nSeqs: int, number of sequences submitted in the request
+  - seconds: float, time spent in the request (submission and parsing)
+  - error: bool, whether the request failed or returned a wrong number of records
+  - jobs: int, number of parallel jobs of the run the request belongs to
+  '''
+  if not historyFile:
+    return
+  record = {'soft': softName, 'time': time.time(), 'nSeqs': nSeqs, 'seconds': seconds, 'error': error, 'jobs': jobs}
+  os.makedirs(os.path.dirname(os.path.abspath(historyFile)), exist_ok=True)
+  with open(historyFile, 'a+') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    f.write(json.dumps(record) + '\n')
+    if f.tell() > MAX_HISTORY_BYTES:
+      compactHistory(f)
+    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def compactHistory(f):
+  '''Rewrites the (locked) history file keeping only the last MAX_RECORDS of each software'''
+  f.seek(0)
+  records = parseHistoryLines(f)
+  f.seek(0)
+  f.truncate()
+  for softRecords in records.values():
+    for record in softRecords:
+      f.write(json.dumps(record) + '\n')
+
+
+def parseHistoryLines(lines):
+  records = {}
+  for line in lines:
+    try:
+      record = json.loads(line)
+    except json.JSONDecodeError:
+      continue
+    records.setdefault(record['soft'], []).append(record)
+  return {softName: softRecords[-MAX_RECORDS:] for softName, softRecords in records.items()}
+
+
+class RunHistory:
+  '''Local history of the observed latencies, batch sizes and errors of the requests to each evaluation software.
+  Used to choose the chunk sizes and parallelism of the evaluations and to predict their runtime.
+  '''
+  def __init__(self, historyFile):
+    self.historyFile = historyFile
+    self.records = {}
+    if historyFile and os.path.exists(historyFile):
+      with open(historyFile) as f:
+        self.records = parseHistoryLines(f)
+
+  def getRecords(self, softName, errors=None, since=None):
+    records = self.records.get(softName, [])
+    if errors is not None:
+      records = [rec for rec in records if rec['error'] == errors]
+    if since is not None:
+      records = [rec for rec in records if rec['time'] >= since]
+    return records
+
+  def hasHistory(self, softName):
+    return len(self.getRecords(softName, errors=False)) >= MIN_RECORDS
+
+  def errorRate(self, softName, since=None):
+    records = self.getRecords(softName, since=since)
+    return sum([rec['error'] for rec in records]) / len(records) if records else 0
+
+  def fitLatency(self, softName):
+    '''Fits the latency of the successful requests as seconds = a + b * nSeqs, weighting the most recent requests.
+    Returns the (a, b) tuple, or None if there is not enough history
+    '''
+    if not self.hasHistory(softName):
+      return None
+    records, now = self.getRecords(softName, errors=False), time.time()
+    ws = [0.5 ** ((now - rec['time']) / HALF_LIFE) for rec in records]
+    ns, ss = [rec['nSeqs'] for rec in records], [rec['seconds'] for rec in records]
+
+    wSum = sum(ws)
+    nMean = sum(w * n for w, n in zip(ws, ns)) / wSum
+    sMean = sum(w * s for w, s in zip(ws, ss)) / wSum
+    nVar = sum(w * (n - nMean) ** 2 for w, n in zip(ws, ns))
+    # All the requests with the same size (e.g: single sequence servers): only the mean latency can be known
+    b = sum(w * (n - nMean) * (s - sMean) for w, n, s in zip(ws, ns, ss)) / nVar if nVar > 0 else 0
+    b = max(b, 0)
+    a = max(sMean - b * nMean, 0)
+    return a, b
+
+  def suggestChunkSize(self, softName, nSeqs, maxChunk=None):
+    '''Returns the number of sequences to submit per request. Chooses the largest size bucket (powers of 2) whose
+    error rate is admissible, using its largest successful size, or the double of it if it is the largest bucket
+    tried so far. Without history, DEFAULT_CHUNK_SIZE is used. The chunks are always bounded, so the evaluations are
+    streamed in several tasks whatever the input size.
+    - nSeqs: int, number of sequences to evaluate
+    - maxChunk: int, maximum number of sequences admitted by the server. MAX_CHUNK_SIZE if None
+    '''
+    maxSize = min(maxChunk or MAX_CHUNK_SIZE, nSeqs)
+    if not self.hasHistory(softName):
+      return max(min(DEFAULT_CHUNK_SIZE, maxSize), 1)
+
+    bucketErrors, bucketSizes = {}, {}
+    for rec in self.getRecords(softName):
+      bucket = 2 ** int(math.log2(max(rec['nSeqs'], 1)))
+      bucketErrors.setdefault(bucket, []).append(rec['error'])
+      if not rec['error']:
+        bucketSizes[bucket] = max(bucketSizes.get(bucket, 0), rec['nSeqs'])
+    goodBuckets = [bucket for bucket, errors in bucketErrors.items()
+                   if bucket in bucketSizes and sum(errors) / len(errors) <= MAX_ERROR_RATE]
+
+    if not goodBuckets:
+      chunkSize = min(bucketErrors) // 2
+    elif max(goodBuckets) == max(bucketErrors):
+      chunkSize = bucketSizes[max(goodBuckets)] * 2
+    else:
+      chunkSize = bucketSizes[max(goodBuckets)]
+    return max(min(chunkSize, maxSize), 1)
+
+  def suggestJobs(self, softNames, nTasks, jobs):
+    '''Returns the number of parallel jobs to use for a set of evaluation tasks: one per task up to the requested
+    jobs, but below the lowest parallelism level whose recent requests have been failing (the servers are probably
+    throttling us). Once those failures are old enough, higher levels are tried again.
+    - softNames: list of the software names of the evaluations to run
+    - nTasks: int, number of pool tasks to run
+    - jobs: int, maximum number of jobs
+    '''
+    nJobs = max(min(jobs, nTasks), 1)
+    levelErrors, since = {}, time.time() - RECENT_TIME
+    for softName in set(softNames):
+      for rec in self.getRecords(softName, since=since):
+        levelErrors.setdefault(rec.get('jobs', 1), []).append(rec['error'])
+
+    badLevels = [level for level, errors in levelErrors.items() if sum(errors) / len(errors) > MAX_ERROR_RATE]
+    if badLevels and min(badLevels) <= nJobs:
+      nJobs = max(min(badLevels) // 2, 1)
+    return nJobs
+
+  def predictRuntime(self, softName, nSeqs, chunkSize):
+    '''Returns the predicted seconds to evaluate nSeqs sequences in chunks of chunkSize, or None if unknown'''
+    fit = self.fitLatency(softName)
+    if fit is None or nSeqs == 0:
+      return None
+    a, b = fit
+    nChunks = math.ceil(nSeqs / chunkSize)
+    return nChunks * (a + b * min(chunkSize, nSeqs))
@@ -24,16 +24,29 @@
 # *
 # **************************************************************************
 
-import time, requests
-from Bio import SeqIO
+import os, re, json, math, time, queue, tempfile, itertools
+from collections import deque
+from array import array
 
-from ..constants import EVAL_PARAM_MAP
+from ..constants import MISSING_SCORE, EVALUATORS
+from .tuning import recordRequest
+from .daemon import isDaemonAvailable, sendDaemonJob, DaemonJobError
+from .metrics import getLocalMetrics, popLocalMetrics
+
+SINGLE_SEQ_TASK = 50  # Sequences per pool task for the servers evaluating one sequence per request
+MAX_RETRIES = 3       # Maximum resubmissions of a failed chunk of sequences
+RETRY_BACKOFF = 5     # Seconds waited before the first resubmission, doubled in each of the next ones
+RESULT_TIMEOUT = 600  # Maximum seconds waiting for the results page of a request
+
+# Selenium drivers reused by the tasks run in each worker process {browserDataKey: driver}
+_workerDrivers = {}
 
 def parseInputProteins(faFile):
   '''Uses BioPython to parse a fasta file and return it as dictionary
   :param faFile: input fasta filename
   :return: {seqName1: seqStr1, ...}
   '''
+  from Bio import SeqIO
   faDic = {}
   with open(faFile) as handle:
     for values in SeqIO.FastaIO.SimpleFastaParser(handle):
@@ -41,16 +54,172 @@ def parseInputProteins(faFile):
   return faDic
 
 
-def reportPoolStatus(poolDic):
-  '''Check the status of the AsynPool objects stored as values of the dictionary and reports when they finish
+def getTaskSize(softName, runData):
+  '''Returns the number of sequences per pool task: one request for the servers admitting multiple sequences and a
+  group of single sequence requests for the rest'''
+  return runData['maxChunk'] if EVALUATORS[softName]['multi'] else SINGLE_SEQ_TASK
+
+
+def getGroupSoftware(variantDics):
+  return list(variantDics.values())[0]['software']
+
+
+def countEvaluationTasks(nSeqs, evalGroups, runDics):
+  return sum([math.ceil(nSeqs / getTaskSize(getGroupSoftware(variantDics), runDics[groupKey]))
+              for groupKey, variantDics in evalGroups.items()])
+
+
+def expandEvalSweeps(evalDics):
+  '''Groups the evaluations with their parameter sweeps expanded: each parameter with a list of values generates one
+  variant evaluation per value (or combination of values), named as {evalKey}_{value}
+  - evalDics: dic, {evalKey: {'software': softName, paramName: paramValue or [paramValues]}}
+  Returns a dic {evalKey: {variantKey: {'software': softName, paramName: paramValue}}}
   '''
-  ready = []
-  while len(ready) < len(poolDic):
-    time.sleep(5)
-    for evalSoft, po in poolDic.items():
-      if po.ready() and evalSoft not in ready:
-        ready.append(evalSoft)
-        print(f'{evalSoft} execution finished ({len(ready)} / {len(poolDic)})')
+  evalGroups = {}
+  for evalKey, evalDic in evalDics.items():
+    sweepParams = [paramName for paramName, value in evalDic.items() if isinstance(value, (list, tuple))]
+    if not sweepParams:
+      evalGroups[evalKey] = {evalKey: evalDic}
+      continue
+
+    evalGroups[evalKey] = {}
+    for values in itertools.product(*[evalDic[paramName] for paramName in sweepParams]):
+      variantKey = '_'.join([evalKey] + [str(value) for value in values])
+      evalGroups[evalKey][variantKey] = {**evalDic, **dict(zip(sweepParams, values))}
+  return evalGroups
+
+
+def iterEvaluationTasks(sequences, evalGroups, runDics, browserData):
+  '''Yields the arguments of the evaluateChunk tasks for a set of evaluations, alternating the evaluations so all of
+  them progress at once. All the variants of a parameter sweep are evaluated in the same task
+  - sequences: dic, sequences {seqId: seqString}
+  - evalGroups: dic, {groupKey: {variantKey: {'software': softName, paramName: paramValue}}} (see expandEvalSweeps)
+  - runDics: dic, {groupKey: runData} execution options for each evaluation (see seleniumRequest)
+  - browserData: dic, contains the information necessary to build the Selenium driver
+  '''
+  seqIds, seqs = list(sequences), list(sequences.values())
+  starts = {groupKey: 0 for groupKey in evalGroups} if seqs else {}
+  while starts:
+    for groupKey in list(starts):
+      softName, start = getGroupSoftware(evalGroups[groupKey]), starts[groupKey]
+      end = start + getTaskSize(softName, runDics[groupKey])
+      variants = {variantKey: {paramName: value for paramName, value in variantDic.items() if paramName != 'software'}
+                  for variantKey, variantDic in evalGroups[groupKey].items()}
+      yield groupKey, softName, start, dict(zip(seqIds[start:end], seqs[start:end])), variants, \
+        browserData, runDics[groupKey]
+
+      if end >= len(seqs):
+        del starts[groupKey]
+      else:
+        starts[groupKey] = end
+
+
+def streamPoolTasks(pool, function, argsIter, maxPending):
+  '''Submits the tasks to the pool keeping at most maxPending of them waiting at once, so the task arguments are not
+  all built in memory, and yields their results as they finish
+  '''
+  results, nPending = queue.Queue(), 0
+  for args in argsIter:
+    pool.apply_async(function, args, callback=results.put, error_callback=results.put)
+    nPending += 1
+    while nPending >= maxPending:
+      yield getPoolResult(results)
+      nPending -= 1
+
+  while nPending > 0:
+    yield getPoolResult(results)
+    nPending -= 1
+
+
+def getPoolResult(results):
+  result = results.get()
+  if isinstance(result, Exception):
+    raise result
+  return result
+
+
+def getWorkerDriver(browserData):
+  '''Returns a selenium driver reused by all the tasks run in the current process, closed when the process exits'''
+  from multiprocessing.util import Finalize
+  driverKey = json.dumps(browserData, sort_keys=True)
+  if driverKey not in _workerDrivers:
+    driver = getDriver(browserData)
+    _workerDrivers[driverKey] = driver
+    Finalize(None, quitDriver, args=(driver, ), exitpriority=10)
+  return _workerDrivers[driverKey]
+
+
+def dropWorkerDriver(browserData):
+  '''Discards the driver of the current process (e.g: after a failure), so the next task uses a new one'''
+  driver = _workerDrivers.pop(json.dumps(browserData, sort_keys=True), None)
+  if driver is not None:
+    quitDriver(driver)
+
+
+def quitDriver(driver):
+  '''Closes a selenium driver, ignoring the errors of an already closed or broken one'''
+  try:
+    driver.quit()
+  except Exception:
+    pass
+
+
+def evaluateChunk(groupKey, softName, start, seqDic, variants, browserData={}, runData={}):
+  '''Pool task evaluating a chunk of sequences with a registered evaluation software.
+  - variants: dic, {evalKey: data} additional web parameters of each evaluation. Several of them for parameter sweeps,
+  which share the input preparation and browser session (see callSweepEvaluator)
+  Returns (start, {evalKey: scores}, metrics), with the scores as compact arrays of floats and the metrics recorded
+  during the evaluation (see metrics.MetricsRegistry.export)
+  '''
+  startTime = time.time()
+  for attempt in range(MAX_RETRIES + 1):
+    useDaemon = isDaemonAvailable(runData.get('daemonSocket'))
+    if runData.get('daemonSocket') and not useDaemon:
+      print(f'{groupKey}: browser daemon not available in {runData["daemonSocket"]}, using a local browser')
+    driver = None if useDaemon else getWorkerDriver(browserData)
+    try:
+      if len(variants) == 1:
+        (evalKey, data), = variants.items()
+        outDics = {evalKey: callEvaluator(softName, seqDic, browserData, data, runData, driver=driver)}
+      else:
+        outDics = callSweepEvaluator(softName, seqDic, variants, browserData, runData, driver=driver)
+      getLocalMetrics().observe('ddg_chunk_seconds', time.time() - startTime, evaluator=groupKey)
+      return start, {evalKey: array('d', outDic['Score']) for evalKey, outDic in outDics.items()}, popLocalMetrics()
+    except Exception as e:
+      # The requests failures are handled by the backend, these are browser or daemon failures
+      if not isRetryableError(e):
+        raise
+      print(f'{groupKey}: chunk evaluation failed ({type(e).__name__}: {e})')
+      if driver is not None:
+        dropWorkerDriver(browserData)
+      if attempt < MAX_RETRIES:
+        time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+  print(f'{groupKey}: {len(seqDic)} sequences will have missing scores')
+  getLocalMetrics().inc('ddg_missing_scores_total', len(seqDic) * len(variants), software=softName)
+  return start, {evalKey: array('d', [MISSING_SCORE] * len(seqDic)) for evalKey in variants}, popLocalMetrics()
+
+
+def reportRuntimePrediction(history, sequences, evalGroups, runDics, nJobs):
+  '''Prints the runtime predicted from the history for each evaluation and for the whole set of them.
+  The variants of parameter sweeps are counted as sequential requests, so their prediction is an upper bound
+  - history: tuning.RunHistory, history of previous requests
+  - sequences: dic, sequences {seqId: seqString}
+  - evalGroups: dic, {evalKey: {variantKey: {'software': softName, ...}}} (see expandEvalSweeps)
+  - runDics: dic, {evalKey: {'maxChunk': chunkSize, ...}}
+  - nJobs: int, number of parallel jobs
+  '''
+  times = {}
+  for evalKey, variantDics in evalGroups.items():
+    times[evalKey] = history.predictRuntime(getGroupSoftware(variantDics), len(sequences), runDics[evalKey]['maxChunk'])
+    times[evalKey] = times[evalKey] * len(variantDics) if times[evalKey] is not None else None
+    predStr = f'{times[evalKey] / 60:.1f} min' if times[evalKey] is not None else 'unknown (no history)'
+    print(f'{evalKey}: chunks of {runDics[evalKey]["maxChunk"]} sequences, predicted runtime {predStr}')
+
+  knownTimes = [t for t in times.values() if t is not None]
+  if knownTimes and len(knownTimes) == len(times):
+    totalTime = max(max(knownTimes), sum(knownTimes) / nJobs)
+    print(f'Predicted runtime with {nJobs} jobs: {totalTime / 60:.1f} min')
 
 
 def divide_chunks(iter, chunkSize):
@@ -80,9 +249,11 @@ def getFastaFiles(seqDic, evalSoft, maxChunk=None):
   fastaStrs = getFastaStrs(seqDic, maxChunk)
   faFiles = []
   for i, fStr in enumerate(fastaStrs):
-    faFiles.append(f'/tmp/{evalSoft}_input_{i}.fa')
-    with open(faFiles[-1], 'w') as f:
+    # Unique names, several evaluations of the same software may be running at once
+    fd, faFile = tempfile.mkstemp(prefix=f'{evalSoft}_input_{i}_', suffix='.fa')
+    with os.fdopen(fd, 'w') as f:
       f.write(fStr)
+    faFiles.append(faFile)
   return faFiles
 
 def setData(driver, paramDic):
@@ -126,7 +297,6 @@ def getDriver(browserData):
 
 
 def performRequest(seqKeys, driver, softData):
-  from selenium.webdriver.common.by import By
   '''Performs a request in a evaluation software using selenium to emulate the browser.
   - seqData: dic, contains the keys and values of the web elements to write, including the
              sequence in the format expected by the web (fasta file, fasta string or sequence string)
@@ -137,6 +307,13 @@ def performRequest(seqKeys, driver, softData):
     - submitCSS: str, css selector to identify the submit button (e.g: "input[name='Submit']")
   - seqKeys: dic, if not None, specifies the web html name key and value to write the sequence name. e.g: {seqName: seq1}
   '''
+  fillRequestForm(seqKeys, driver, softData).click()
+  return driver
+
+
+def fillRequestForm(seqKeys, driver, softData):
+  '''Loads the web form of the evaluation software and fills it (see performRequest). Returns the submit element'''
+  from selenium.webdriver.common.by import By
   driver.get(softData['url'])
 
   for xKeyName, xKeyVal in seqKeys.items():
@@ -144,41 +321,82 @@ def performRequest(seqKeys, driver, softData):
     extraElem.send_keys(xKeyVal)
 
   driver = setData(driver, softData['params'])
-  driver.find_elements(By.CSS_SELECTOR, softData['submitCSS'])[0].click()
-  return driver
+  return driver.find_elements(By.CSS_SELECTOR, softData['submitCSS'])[0]
 
 
-def getSeqData(seqDic, softData):
+def getSeqData(seqDic, softData, maxChunk=None):
   '''Returns a list containing the chunks of sequences as expected from the web to use.
-  It can be either: a list with one fasta file, a list with one fasta string or a list with sequences strings
+  It can be either: a list with fasta files, a list with fasta strings or a list with sequences strings
   - seqDic: dic, sequences {seqId: seqString}
   - softData: dic, containing all the characteristics and info for the specific sofware web. Among others (key: value):
     - multi: whether the web admits multiple sequences at one time
     - seqFormat: whether to return a fasta file ("fastaFile") or the fasta string ("fastaString")
     - softName: software name for the fasta file to be named
+  - maxChunk: int, maximum number of sequences per fasta (all of them if None)
   '''
   if softData['multi']:
     if softData['seqFormat'] == 'fastaFile':
-      seqData = getFastaFiles(seqDic, softData['softName'])
+      seqData = getFastaFiles(seqDic, softData['softName'], maxChunk)
     else:
-      seqData = getFastaStrs(seqDic)
+      seqData = getFastaStrs(seqDic, maxChunk)
   else:
     seqData = list(seqDic.values())
   return seqData
 
 
-def updateBatchDic(outDic, batchDic):
-  '''Updates(appends) the lists inside the outDic values with the ones in the batchDic
+def getChunkIndexes(nSeqs, softData, maxChunk=None):
+  '''Returns the indexes of the sequences included in each request: chunks of maxChunk sequences for the servers
+  admitting multiple sequences, one sequence otherwise'''
+  if not softData['multi']:
+    return [[i] for i in range(nSeqs)]
+  maxChunk = nSeqs if not maxChunk else maxChunk
+  return [list(range(i, min(i + maxChunk, nSeqs))) for i in range(0, nSeqs, maxChunk)]
+
+
+def validateSequences(seqs, validData):
+  '''Checks locally whether the sequences are suitable for a software web server before submitting them.
+  Returns a boolean numpy array with True for the valid sequences.
+  - seqs: iterable of sequence strings
+  - validData: dic, validation rules for the specific software. Among others (key: value):
+    - alphabet: str, admitted residues (case insensitive). Gaps, stop codons or non-standard residues are rejected
+    - minLength: int, minimum admitted sequence length
+    - maxLength: int, maximum admitted sequence length
   '''
-  for key, values in batchDic.items():
-    if key in outDic:
-      outDic[key] += values
-    else:
-      outDic[key] = values
+  import numpy as np
+  seqs = list(seqs)
+  lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+  valid = lengths > 0
+  if validData.get('minLength'):
+    valid &= lengths >= validData['minLength']
+  if validData.get('maxLength'):
+    valid &= lengths <= validData['maxLength']
+
+  if validData.get('alphabet') and len(seqs) > 0:
+    allowed = np.zeros(256, dtype=bool)
+    allowed[np.frombuffer(validData['alphabet'].upper().encode('ascii'), dtype=np.uint8)] = True
+    # Non ascii characters are replaced by a single "?" before the (ascii only) upper case conversion, so the string
+    # keeps one byte per residue (e.g: "ß".upper() would be "SS")
+    codes = np.frombuffer(''.join(seqs).encode('ascii', errors='replace').upper(), dtype=np.uint8)
+    badCumSum = np.concatenate([[0], np.cumsum(~allowed[codes])])
+    ends = np.cumsum(lengths)
+    valid &= badCumSum[ends] - badCumSum[ends - lengths] == 0
+  return valid
+
+
+def fillMissingScores(outDic, validMask):
+  '''Expands the score lists obtained for the valid sequences to the whole set of sequences, setting MISSING_SCORE
+  for the invalid ones, so they keep aligned with the input sequences
+  '''
+  import numpy as np
+  for key, values in outDic.items():
+    fullValues = np.full(len(validMask), MISSING_SCORE)
+    fullValues[validMask] = values
+    outDic[key] = fullValues.tolist()
   return outDic
 
 
-def seleniumRequest(seqDic, softData, browserData, parseFunction, seqNameKey=None):
+def seleniumRequest(seqDic, softData, browserData, parseFunction, seqNameKey=None, validData={}, runData={},
+                    driver=None):
   '''Perform a series of Selenium requests an operations to emulate the evaluation of a set of sequences by a software
   web server.
   - seqDic: dic, sequences {seqId: seqString}
@@ -186,23 +404,323 @@ def seleniumRequest(seqDic, softData, browserData, parseFunction, seqNameKey=Non
   - browserData: dic, contains the information necessary to build the Selenium driver
   - parseFunction: func, parses the driver data once the request is performed and returns a dic {'Score' [sc1, ...]}
   - seqNameKey: str, if not None, include the sequence name as a web element value to write in this key
+  - validData: dic, validation rules for the sequences (see validateSequences). Invalid sequences are not submitted
+  and get MISSING_SCORE
+  - runData: dic, execution options. Among others (key: value):
+    - maxChunk: int, maximum number of sequences per request for the servers admitting multiple sequences
+    - historyFile: str, file where the requests timings are recorded (see tuning.RunHistory)
+    - jobs: int, number of parallel jobs of the run, recorded with the requests
+  - driver: selenium driver to use. If None, a new one is created for these requests and closed afterwards
   '''
-  # url, data, softName, seqFormat='fastaString', seqName='sequence', multi=True
-  driver = getDriver(browserData)
-  seqData = getSeqData(seqDic, softData)
+  seqDic, validMask = filterValidSequences(seqDic, validData, softData['softName'])
 
   # Performing one request for each chunk of admitted data (just once if fasta admitted)
-  outDic = {}
-  for i, seq in enumerate(seqData):
-    curSeqKeys = {softData['seqName']: seq}
-    if seqNameKey:
-      curSeqKeys.update({seqNameKey: f'seq{i + 1}'})
+  outDic = {'Score': []}
+  if not seqDic:
+    return fillMissingScores(outDic, validMask)
 
-    driver = performRequest(curSeqKeys, driver, softData)
+  # url, data, softName, seqFormat='fastaString', seqName='sequence', multi=True
+  ownDriver = driver is None
+  driver = getDriver(browserData) if ownDriver else driver
+  try:
+    outDic = runSeleniumChunks(seqDic, softData, driver, parseFunction, seqNameKey, runData)
+  finally:
+    if ownDriver:
+      quitDriver(driver)
+  return fillMissingScores(outDic, validMask)
+
+
+def seleniumSweepRequest(seqDic, softData, browserData, parseFunction, variantParams, seqNameKey=None, validData={},
+                         runData={}, driver=None):
+  '''Perform the Selenium requests to evaluate a set of sequences with several parameter variants of a software web
+  server, sharing the sequences validation, the inputs preparation and the browser session (see runSeleniumSweep).
+  - variantParams: dic, {variantKey: params} additional data parameters to fill in the web form for each variant
+  The rest of arguments are the same as in seleniumRequest
+  Returns a dic {variantKey: {'Score' [sc1, ...]}}
+  '''
+  seqDic, validMask = filterValidSequences(seqDic, validData, softData['softName'])
+  outDics = {variantKey: {'Score': []} for variantKey in variantParams}
+  if seqDic:
+    ownDriver = driver is None
+    driver = getDriver(browserData) if ownDriver else driver
+    try:
+      outDics = runSeleniumSweep(seqDic, softData, variantParams, driver, parseFunction, seqNameKey, runData)
+    finally:
+      if ownDriver:
+        quitDriver(driver)
+  return {variantKey: fillMissingScores(outDic, validMask) for variantKey, outDic in outDics.items()}
+
+
+def filterValidSequences(seqDic, validData, softName):
+  '''Returns the dictionary of the sequences passing the validation (see validateSequences) and the validation mask'''
+  validMask = validateSequences(seqDic.values(), validData)
+  if not validMask.all():
+    getLocalMetrics().inc('ddg_invalid_sequences_total', int(len(validMask) - validMask.sum()), software=softName)
+    print(f'{softName}: {len(validMask) - validMask.sum()} / {len(validMask)} sequences not valid for '
+          f'the server. They will not be submitted')
+  return {seqId: seq for (seqId, seq), valid in zip(seqDic.items(), validMask) if valid}, validMask
+
+
+def runSeleniumChunks(seqDic, softData, driver, parseFunction, seqNameKey=None, runData={}):
+  '''Performs the selenium requests for the chunks of sequences using the driver (see seleniumRequest).
+  Each chunk is checked independently, so a failure only causes the resubmission of its own sequences:
+    - Failed requests are resubmitted up to MAX_RETRIES times, with exponential backoff
+    - Chunks returning a wrong number of records only resubmit the sequences not returned, if the parser identifies
+    the records (see parseRecordIds). Otherwise, they are split in halves to isolate those sequences
+  The sequences that still fail get MISSING_SCORE, keeping the scores aligned with the input sequences
+  '''
+  seqs = list(seqDic.values())
+  maxChunk, historyFile = runData.get('maxChunk'), runData.get('historyFile')
+  outDic = {'Score': [MISSING_SCORE] * len(seqs)}
+
+  pending, nRequests = deque([(idxs, 0) for idxs in getChunkIndexes(len(seqs), softData, maxChunk)]), 0
+  while pending:
+    idxs, attempt = pending.popleft()
+    batchDic, error = requestSeleniumChunk([seqs[i] for i in idxs], softData, driver, parseFunction,
+                                           seqNameKey, nRequests, historyFile, runData.get('jobs', 1))
+    nRequests += 1
+    if not error:
+      setBatchScores(outDic, idxs, batchDic, len(seqs))
+
+    elif batchDic is not None and 'ID' in batchDic:
+      doneIdxs = setBatchScores(outDic, idxs, batchDic, len(seqs))
+      missIdxs = [i for i in idxs if i not in doneIdxs]
+      # It only counts as a new attempt if none of the sequences was returned
+      nextAttempt = attempt if doneIdxs else attempt + 1
+      if missIdxs and nextAttempt <= MAX_RETRIES:
+        getLocalMetrics().inc('ddg_resubmissions_total', software=softData['softName'], reason='records')
+        print(f'{softData["softName"]}: {error}. Resubmitting the {len(missIdxs)} sequences not returned')
+        if nextAttempt > attempt:
+          time.sleep(RETRY_BACKOFF * 2 ** attempt)
+        pending.appendleft((missIdxs, nextAttempt))
+      elif missIdxs:
+        getLocalMetrics().inc('ddg_missing_scores_total', len(missIdxs), software=softData['softName'])
+        print(f'{softData["softName"]}: {error}. {len(missIdxs)} sequences will have missing scores')
+
+    elif batchDic is not None and len(idxs) > 1:
+      getLocalMetrics().inc('ddg_resubmissions_total', software=softData['softName'], reason='records')
+      print(f'{softData["softName"]}: {error}. Resubmitting the chunk sequences in halves')
+      # The server may be truncating the results because of throttling
+      time.sleep(RETRY_BACKOFF * 2 ** attempt)
+      pending.extendleft([(idxs[len(idxs) // 2:], attempt), (idxs[:len(idxs) // 2], attempt)])
+
+    elif attempt < MAX_RETRIES:
+      getLocalMetrics().inc('ddg_resubmissions_total', software=softData['softName'], reason='retry')
+      print(f'{softData["softName"]}: {error}. Resubmitting {len(idxs)} sequences '
+            f'(retry {attempt + 1} / {MAX_RETRIES})')
+      time.sleep(RETRY_BACKOFF * 2 ** attempt)
+      pending.appendleft((idxs, attempt + 1))
+
+    else:
+      getLocalMetrics().inc('ddg_missing_scores_total', len(idxs), software=softData['softName'])
+      print(f'{softData["softName"]}: {error}. {len(idxs)} sequences will have missing scores')
+  return outDic
+
+
+def runSeleniumSweep(seqDic, softData, variantParams, driver, parseFunction, seqNameKey=None, runData={}):
+  '''Performs the selenium requests of several parameter variants of a software for the chunks of sequences.
+  The input of each chunk is prepared once and every variant is submitted in its own tab of the same browser session
+  before collecting any result, so the server can process them concurrently. The variants failing for a chunk are
+  resubmitted individually (see runSeleniumChunks).
+  Returns a dic {variantKey: {'Score' [sc1, ...]}}
+  '''
+  seqs = list(seqDic.values())
+  maxChunk = runData.get('maxChunk')
+  outDics = {variantKey: {'Score': [MISSING_SCORE] * len(seqs)} for variantKey in variantParams}
+
+  mainHandle = driver.current_window_handle
+  for requestIdx, idxs in enumerate(getChunkIndexes(len(seqs), softData, maxChunk)):
+    chunkSeqs = [seqs[i] for i in idxs]
+    curSeqKeys, seq = getChunkSeqKeys(chunkSeqs, softData, seqNameKey, requestIdx)
+    results, submitElements, starts, seconds = {}, {}, {}, {}
+    try:
+      handles = {}
+      for variantKey, params in variantParams.items():
+        if handles:
+          driver.switch_to.new_window('tab')
+        handles[variantKey], starts[variantKey] = driver.current_window_handle, time.time()
+        try:
+          submitElements[variantKey] = fillRequestForm(curSeqKeys, driver, {**softData, 'params': params})
+          # Clicking through javascript does not wait for the results page, so the next variants are submitted meanwhile
+          driver.execute_script('arguments[0].click();', submitElements[variantKey])
+        except Exception as e:
+          if isBrokenDriverError(e):
+            raise
+          results[variantKey] = (None, f'request failed ({type(e).__name__}: {e})')
+
+      for variantKey, handle in handles.items():
+        if variantKey not in results:
+          driver.switch_to.window(handle)
+          results[variantKey] = collectSeleniumChunk(driver, parseFunction, len(chunkSeqs), softData['softName'],
+                                                     submitElements[variantKey])
+        seconds[variantKey] = time.time() - starts[variantKey]
+    finally:
+      closeExtraTabs(driver, mainHandle)
+      removeChunkInput(seq, softData)
+
+    for variantKey, (batchDic, error) in results.items():
+      # The variants requests overlap, so they are not recorded in the history, which models single requests
+      recordSeleniumChunk(softData['softName'], len(chunkSeqs), seconds[variantKey], error)
+      doneIdxs = set()
+      if not error or (batchDic is not None and 'ID' in batchDic):
+        doneIdxs = setBatchScores(outDics[variantKey], idxs, batchDic, len(seqs))
+
+      missIdxs = [i for i in idxs if i not in doneIdxs]
+      if missIdxs:
+        print(f'{softData["softName"]} ({variantKey}): {error}. Resubmitting {len(missIdxs)} sequences')
+        missDic = runSeleniumChunks({i: seqs[i] for i in missIdxs}, {**softData, 'params': variantParams[variantKey]},
+                                    driver, parseFunction, seqNameKey, {**runData, 'maxChunk': None})
+        setBatchScores(outDics[variantKey], missIdxs, missDic, len(seqs))
+  return outDics
+
+
+def setBatchScores(outDic, idxs, batchDic, nSeqs):
+  '''Sets the values of the records returned for the chunk of sequences with indexes idxs in outDic, whose lists have
+  nSeqs values. If the parser identified the records ("ID" key, positions in the chunk), only those are set.
+  Returns the set of indexes of the sequences set
+  '''
+  if 'ID' in batchDic:
+    pairs = [(idxs[recId], k) for k, recId in enumerate(batchDic['ID']) if 0 <= recId < len(idxs)]
+  else:
+    pairs = list(zip(idxs, range(len(batchDic['Score']))))
+
+  for key, values in batchDic.items():
+    if key != 'ID':
+      keyValues = outDic.setdefault(key, [MISSING_SCORE] * nSeqs)
+      for i, k in pairs:
+        keyValues[i] = values[k]
+  return {i for i, _ in pairs}
+
+
+def closeExtraTabs(driver, mainHandle):
+  for handle in driver.window_handles:
+    if handle != mainHandle:
+      driver.switch_to.window(handle)
+      driver.close()
+  driver.switch_to.window(mainHandle)
+
+
+def getChunkSeqKeys(seqs, softData, seqNameKey=None, requestIdx=0):
+  '''Prepares the input of a request for a chunk of sequences, as expected by the web (see getSeqData).
+  Returns the web elements to write {elementName: value} and the input itself (fasta file, fasta string or sequence)
+  '''
+  seq = getSeqData(dict(enumerate(seqs)), softData)[0] if softData['multi'] else seqs[0]
+  curSeqKeys = {softData['seqName']: seq}
+  if seqNameKey:
+    curSeqKeys.update({seqNameKey: f'seq{requestIdx + 1}'})
+  return curSeqKeys, seq
+
+
+def removeChunkInput(seq, softData):
+  if softData['multi'] and softData['seqFormat'] == 'fastaFile':
+    os.remove(seq)
+
+
+def collectSeleniumChunk(driver, parseFunction, nSeqs, softName, submitElement=None):
+  '''Parses the results of a request for a chunk of nSeqs sequences from the driver page.
+  If the submit element of a request sent without waiting is passed, waits first until the form page is left, so the
+  parser does not find the form page.
+  Returns the parsed dic {'Score' [sc1, ...]} (None if the parsing failed) and a description of the error, if any
+  '''
+  batchDic, error, metrics = None, None, getLocalMetrics()
+  try:
+    if submitElement is not None:
+      waitPageChange(driver, submitElement)
     # Parse the driver with the corresponding function for each software
+    parseStart = time.time()
     batchDic = parseFunction(driver)
-    outDic = updateBatchDic(outDic, batchDic)
-  return outDic
+    metrics.observe('ddg_parse_seconds', time.time() - parseStart, software=softName)
+    metrics.inc('ddg_parsed_records_total', len(batchDic['Score']), software=softName)
+    if len(batchDic['Score']) != nSeqs:
+      error = f'{len(batchDic["Score"])} records returned for {nSeqs} sequences submitted'
+  except Exception as e:
+    if isBrokenDriverError(e):
+      raise
+    error = f'request failed ({type(e).__name__}: {e})'
+  return batchDic, error
+
+
+def recordSeleniumChunk(softName, nSeqs, seconds, error, historyFile=None, jobs=1):
+  '''Records a request in the metrics and in the history'''
+  metrics = getLocalMetrics()
+  metrics.observe('ddg_request_seconds', seconds, software=softName)
+  metrics.inc('ddg_requests_total', software=softName, status='error' if error else 'ok')
+  metrics.inc('ddg_sequences_submitted_total', nSeqs, software=softName)
+  recordRequest(historyFile, softName, nSeqs, seconds, error=error is not None, jobs=jobs)
+
+
+def requestSeleniumChunk(seqs, softData, driver, parseFunction, seqNameKey=None, requestIdx=0, historyFile=None,
+                         jobs=1):
+  '''Performs the selenium request for a chunk of sequences and records it in the history.
+  Returns the parsed dic {'Score' [sc1, ...]} (None if the request failed) and a description of the error, if any
+  '''
+  curSeqKeys, seq = getChunkSeqKeys(seqs, softData, seqNameKey, requestIdx)
+  start, batchDic, error = time.time(), None, None
+  try:
+    driver = performRequest(curSeqKeys, driver, softData)
+    batchDic, error = collectSeleniumChunk(driver, parseFunction, len(seqs), softData['softName'])
+  except Exception as e:
+    if isBrokenDriverError(e):
+      raise
+    error = f'request failed ({type(e).__name__}: {e})'
+  finally:
+    removeChunkInput(seq, softData)
+
+  recordSeleniumChunk(softData['softName'], len(seqs), time.time() - start, error, historyFile, jobs)
+  return batchDic, error
+
+
+REQUEST_BACKENDS = {'selenium': seleniumRequest}
+SWEEP_BACKENDS = {'selenium': seleniumSweepRequest}
+
+
+def isRetryableError(e):
+  '''Returns whether the exception comes from the browser, the daemon or the connections, so evaluating the chunk
+  again may fix it. Other exceptions (e.g: programming errors) should not be retried'''
+  from urllib3.exceptions import HTTPError
+  from selenium.common.exceptions import WebDriverException
+  return isinstance(e, (WebDriverException, OSError, HTTPError, DaemonJobError))
+
+
+def isBrokenDriverError(e):
+  '''Returns whether the exception means the browser session is lost, so it cannot be fixed by resubmitting with the
+  same driver: lost sessions or windows, failed connections with the driver (e.g: dead chromedriver) and generic
+  WebDriverException (e.g: "chrome not reachable"). The page level errors (missing elements, timeouts) are not'''
+  from urllib3.exceptions import HTTPError
+  from selenium.common.exceptions import WebDriverException, InvalidSessionIdException, NoSuchWindowException, \
+    SessionNotCreatedException
+  return isinstance(e, (InvalidSessionIdException, NoSuchWindowException, SessionNotCreatedException,
+                        ConnectionError, HTTPError)) or type(e) is WebDriverException
+
+
+def waitElements(driver, cssSelector, timeout=RESULT_TIMEOUT):
+  '''Waits until the web elements matching the css selector are present in the driver page and returns them.
+  Raises a TimeoutError if they do not appear in timeout seconds'''
+  from selenium.webdriver.common.by import By
+  start = time.time()
+  data = driver.find_elements(By.CSS_SELECTOR, cssSelector)
+  while not data:
+    if time.time() - start > timeout:
+      raise TimeoutError(f'Results ({cssSelector}) not found after {timeout} seconds')
+    time.sleep(5)
+    data = driver.find_elements(By.CSS_SELECTOR, cssSelector)
+  return data
+
+
+def parseRecordIds(resultText, nRecords):
+  '''Identifies the records of a results text from the sequence names of the submitted fasta (seq{i}, see
+  buildSeqFasta) echoed by the server. Returns the list of their positions in the submitted chunk, or None if they
+  cannot be identified for all the records'''
+  recIds = list(dict.fromkeys([int(seqNum) - 1 for seqNum in re.findall(r'\bseq(\d+)\b', resultText)]))
+  return recIds if len(recIds) == nRecords else None
+
+
+def waitPageChange(driver, element, timeout=RESULT_TIMEOUT):
+  '''Waits until the web element is no longer attached to the driver page, i.e: the browser has navigated to a new
+  page. Raises a selenium TimeoutException if it does not happen in timeout seconds'''
+  from selenium.webdriver.support.ui import WebDriverWait
+  from selenium.webdriver.support import expected_conditions as EC
+  WebDriverWait(driver, timeout).until(EC.staleness_of(element))
 
 
 def innerSplit(text, preText, endText):
@@ -214,6 +732,7 @@ def innerSplit(text, preText, endText):
 ########## REQUESTS ##########
 
 def makeRequest(url, action='post', data={}, headers={}):
+  import requests
   if action == 'post':
     response = requests.post(url, data=data, headers=headers)
   else:
@@ -228,53 +747,117 @@ def makeRequest(url, action='post', data={}, headers={}):
 
 ########### SELENIUM CALLS ################
 
-def callVaxijen3(sequences, browserData={}, data={}):
-  softData = {'url': "https://www.ddg-pharmfac.net/vaxijen3/",
-              'multi': True, 'seqFormat': 'fastaFile', 'softName': 'Vaxijen3',
-              'seqName': 'uploaded_file', 'params': data, 'submitCSS': "input[name='submit']"}
-
-  outDic = seleniumRequest(sequences, softData, browserData, parseVaxijen3)
-  return outDic
+def getEvaluatorSoftData(softName, data={}):
+  '''Builds the softData dictionary expected by the request backends from the evaluators registry
+  - softName: str, name of the evaluation software, as registered in constants.EVALUATORS
+  - data: dic, additional data parameters to fill in the web form, either with the web form or the protocol parameter
+  names (see mapFormParams). They update the registered default ones
+  '''
+  evalData = EVALUATORS[softName]
+  softData = {key: evalData[key] for key in ['url', 'multi', 'seqFormat', 'seqName', 'submitCSS'] if key in evalData}
+  params = {**evalData.get('defaultParams', {}), **mapFormParams(softName, data)}
+  softData.update({'softName': softName, 'params': params})
+  return softData
 
 
-def callVaxijen2(sequences, browserData={}, data={}):
-  data = {"Target": 'Bacteria'} if not data else data
+def mapFormParams(softName, data):
+  '''Maps the protocol parameters of an evaluation to the names and values of the web form elements they set
+  (constants.EVALUATORS formParams). The parameters not registered are kept as they are. Lists of values (parameter
+  sweeps) are mapped value by value
+  '''
+  formParams = EVALUATORS.get(softName, {}).get('formParams', {})
+  params = {}
+  for paramName, value in data.items():
+    if paramName in formParams:
+      paramName, formValues = formParams[paramName]
+      if isinstance(value, (list, tuple)):
+        value = [formValues.get(v, v) for v in value]
+      else:
+        value = formValues.get(value, value)
+    params[paramName] = value
+  return params
+
+
+def callEvaluator(softName, sequences, browserData={}, data={}, runData={}, driver=None):
+  '''Evaluates a set of sequences with a registered evaluation software (see constants.EVALUATORS)
+  - softName: str, name of the evaluation software
+  - sequences: dic, sequences {seqId: seqString}
+  - browserData: dic, contains the information necessary to build the Selenium driver
+  - data: dic, additional data parameters to fill in the web form
+  - runData: dic, execution options (see seleniumRequest). If it contains a "daemonSocket" of a running browser
+  daemon (see daemon.py), the job is sent to it instead of launching a new browser
+  - driver: selenium driver to use. If None, a new one is created for the evaluation
+  Returns a dic {'Score': [sc1, ...]}
+  '''
+  if driver is None and isDaemonAvailable(runData.get('daemonSocket')):
+    socketFile = runData['daemonSocket']
+    runData = {key: value for key, value in runData.items() if key != 'daemonSocket'}
+    outDic = sendDaemonJob(socketFile, {'softName': softName, 'sequences': sequences,
+                                        'browserData': browserData, 'data': data, 'runData': runData},
+                           timeout=getJobTimeout(softName, len(sequences)))
+    getLocalMetrics().merge(outDic.pop('metrics', {}))
+    return outDic
+
+  evalData = EVALUATORS[softName]
+  softData = getEvaluatorSoftData(softName, data)
+  requestFunction, parseFunction = REQUEST_BACKENDS[evalData['backend']], globals()[evalData['parser']]
+  return requestFunction(sequences, softData, browserData, parseFunction,
+                         validData=evalData.get('validation', {}), runData=runData, driver=driver)
+
+
+def getJobTimeout(softName, nSeqs, nVariants=1):
+  '''Returns an upper bound of the seconds an evaluation job can take. Each request attempt waits up to RESULT_TIMEOUT
+  for its results (and as much for the page change in sweeps), and is retried MAX_RETRIES times with backoff. The
+  chunks returning missing records can take up to two requests per sequence (see runSeleniumChunks)
+  '''
+  nRequests = 2 * nSeqs if EVALUATORS[softName]['multi'] else nSeqs
+  attemptTime = 2 * RESULT_TIMEOUT if nVariants > 1 else RESULT_TIMEOUT
+  requestTime = (MAX_RETRIES + 1) * attemptTime + RETRY_BACKOFF * (2 ** MAX_RETRIES - 1)
+  return max(nRequests, 1) * nVariants * requestTime
+
+
+def callSweepEvaluator(softName, sequences, variants, browserData={}, runData={}, driver=None):
+  '''Evaluates a set of sequences with several parameter variants of a registered evaluation software, sharing the
+  inputs preparation and the browser session
+  - variants: dic, {variantKey: data} additional data parameters to fill in the web form for each variant
+  The rest of arguments are the same as in callEvaluator
+  Returns a dic {variantKey: {'Score': [sc1, ...]}}
+  '''
+  if driver is None and isDaemonAvailable(runData.get('daemonSocket')):
+    socketFile = runData['daemonSocket']
+    runData = {key: value for key, value in runData.items() if key != 'daemonSocket'}
+    outDics = sendDaemonJob(socketFile, {'softName': softName, 'sequences': sequences, 'variants': variants,
+                                         'browserData': browserData, 'runData': runData},
+                            timeout=getJobTimeout(softName, len(sequences), len(variants)))
+    getLocalMetrics().merge(outDics.pop('metrics', {}))
+    return outDics
 
-  softData = {'url': "https://www.ddg-pharmfac.net/vaxijen/VaxiJen/VaxiJen.html",
-              'multi': True, 'seqFormat': 'fastaFile', 'softName': 'Vaxijen2',
-              'seqName': 'uploaded_file', 'params': data, 'submitCSS': "input[name='submit']"}
+  evalData = EVALUATORS[softName]
+  variantParams = {variantKey: getEvaluatorSoftData(softName, data)['params'] for variantKey, data in variants.items()}
+  requestFunction, parseFunction = SWEEP_BACKENDS[evalData['backend']], globals()[evalData['parser']]
+  return requestFunction(sequences, getEvaluatorSoftData(softName), browserData, parseFunction, variantParams,
+                         validData=evalData.get('validation', {}), runData=runData, driver=driver)
 
-  outDic = seleniumRequest(sequences, softData, browserData, parseVaxijen2)
 
-  return outDic
+def callVaxijen3(sequences, browserData={}, data={}, runData={}):
+  return callEvaluator('Vaxijen3', sequences, browserData, data, runData)
 
 
-def callAllerTop2(sequences, browserData={}, data={}):
-  softData = {'url': "https://www.ddg-pharmfac.net/AllerTOP/",
-              'multi': False,
-              'seqName': 'sequence', 'params': data, 'submitCSS': "input[name='Submit']"}
+def callVaxijen2(sequences, browserData={}, data={}, runData={}):
+  return callEvaluator('Vaxijen2', sequences, browserData, data, runData)
 
-  outDic = seleniumRequest(sequences, softData, browserData, parseAllerDDG)
 
-  return outDic
+def callAllerTop2(sequences, browserData={}, data={}, runData={}):
+  return callEvaluator('AllerTop2', sequences, browserData, data, runData)
 
 
-def callAllergenFP1(sequences, browserData={}, data={}):
-  softData = {'url': "https://ddg-pharmfac.net/AllergenFP/",
-              'multi': False,
-              'seqName': 'sequence', 'params': data, 'submitCSS': "input[name='Submit']"}
-
-  outDic = seleniumRequest(sequences, softData, browserData, parseAllerDDG)
-  return outDic
+def callAllergenFP1(sequences, browserData={}, data={}, runData={}):
+  return callEvaluator('AllergenFP1', sequences, browserData, data, runData)
 
 ############## PARSING ##############
 
 def parseVaxijen3(driver):
-  from selenium.webdriver.common.by import By
-  data = driver.find_elements(By.CSS_SELECTOR, "table[class='boilerplate']")
-  while not data:
-    time.sleep(5)
-    data = driver.find_elements(By.CSS_SELECTOR, "table[class='boilerplate']")
+  data = waitElements(driver, "table[class='boilerplate']")
   resultText = data[0].text
 
   results = innerSplit(resultText, 'is predicted to be', 'with')
@@ -285,15 +868,14 @@ def parseVaxijen3(driver):
     posNeg = 1 if results[i] == 'Probable ANTIGEN' else -1
     resDic['Score'].append(float(probs[i].replace('%', '')) * posNeg * 0.01)
 
+  recIds = parseRecordIds(resultText, len(resDic['Score']))
+  if recIds is not None:
+    resDic['ID'] = recIds
   return resDic
 
 
 def parseVaxijen2(driver):
-  from selenium.webdriver.common.by import By
-  data = driver.find_elements(By.CSS_SELECTOR, "table[border='0']")
-  while not data:
-    time.sleep(5)
-    data = driver.find_elements(By.CSS_SELECTOR, "table[border='0']")
+  data = waitElements(driver, "table[border='0']")
   resultText = data[0].text
 
   results = innerSplit(resultText, '(', ')')
@@ -304,15 +886,14 @@ def parseVaxijen2(driver):
     posNeg = 1 if results[i] == 'Probable ANTIGEN' else -1
     resDic['Score'].append(float(probs[i].replace('%', '')) * posNeg)
 
+  recIds = parseRecordIds(resultText, len(resDic['Score']))
+  if recIds is not None:
+    resDic['ID'] = recIds
   return resDic
 
 
 def parseAllerDDG(driver):
-  from selenium.webdriver.common.by import By
-  data = driver.find_elements(By.CSS_SELECTOR, "table[border='0']")
-  while not data:
-    time.sleep(5)
-    data = driver.find_elements(By.CSS_SELECTOR, "table[border='0']")
+  data = waitElements(driver, "table[border='0']")
   resultText = data[0].text
 
   results = innerSplit(resultText, 'Your sequence is:\n', '\n')
@@ -323,11 +904,12 @@ def parseAllerDDG(driver):
   return resDic
 
 def mapEvalParamNames(sDic):
+  '''Maps the protocol parameters of each evaluation to the web form ones (see mapFormParams)
+  - sDic: dic, {evalKey: {'software': softName, paramName: paramValue}}
+  '''
   wsDic = {}
   for sName, curSDic in sDic.items():
-    wsDic[sName] = {}
-    for paramName, paramValue in curSDic.items():
-      if paramName in EVAL_PARAM_MAP:
-        paramName = EVAL_PARAM_MAP[paramName]
-      wsDic[sName][paramName] = paramValue
+    softName = curSDic['software']
+    data = {paramName: paramValue for paramName, paramValue in curSDic.items() if paramName != 'software'}
+    wsDic[sName] = {'software': softName, **mapFormParams(softName, data)}
   return wsDic